@@ -0,0 +1,143 @@
+""" Review statistics computed with NumPy over the review_events columns """
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+DAY = 24 * 60 * 60
+UTC_OFFSET = 5 * 60 * 60  # Asia/Tashkent (database.TIMEZONE), which has no DST
+
+# flashcard_id, reviewed_at (whole seconds), correct, interval: 13 bytes per cached event
+COLUMN_TYPES = (np.int32, np.uint32, np.int8, np.int32)
+
+# user_id -> (last event id, columns), least recently used first; bounded by the events cached over all users
+CACHE_EVENTS = int(os.getenv("ANALYTICS_CACHE_EVENTS", "2000000"))
+_events = OrderedDict()
+_cached_events = 0
+_events_lock = threading.Lock()  # user_summary runs in worker threads
+
+
+def _take(user_id):
+    """ Remove the cache entry of a user and return it, (0, None) if there is none """
+    global _cached_events
+    last_id, columns = _events.pop(user_id, (0, None))
+    if columns is not None:
+        _cached_events -= columns[0].size
+    return last_id, columns
+
+
+def load_events(user_id, fetch_events):
+    """ Event columns of a user; only events newer than the cached ones are read via `fetch_events` """
+    global _cached_events
+    with _events_lock:
+        last_id, columns = _take(user_id)
+    if columns is None:
+        columns = tuple(np.empty(0, dtype) for dtype in COLUMN_TYPES)
+
+    rows = fetch_events(user_id, last_id)
+    if rows:
+        new = np.array(rows, dtype=np.float64)
+        last_id = int(new[-1, 0])
+        columns = tuple(np.concatenate((column, new[:, i + 1].astype(dtype)))
+                        for i, (column, dtype) in enumerate(zip(columns, COLUMN_TYPES)))
+
+    with _events_lock:
+        _take(user_id)  # loaded at the same time by another thread
+        _events[user_id] = (last_id, columns)
+        _cached_events += columns[0].size
+        while _cached_events > CACHE_EVENTS and len(_events) > 1:
+            _take(next(iter(_events)))
+    return columns
+
+
+def to_columns(columns):
+    """ (flashcard_id, reviewed_at, correct, interval) columns sorted by card, then time, widened for arithmetic """
+    card, reviewed_at, correct, interval = columns
+    order = np.lexsort((reviewed_at, card))
+    return (card[order].astype(np.int64), reviewed_at[order].astype(np.float64),
+            correct[order].astype(np.int64), interval[order].astype(np.int64))
+
+
+def retention_curve(card, reviewed_at, correct, max_days=30):
+    """ Recall rate by days since the previous review of the same card. Returns (reviews, recall_rate) per day """
+    same_card = card[1:] == card[:-1]
+    elapsed = (reviewed_at[1:] - reviewed_at[:-1])[same_card] / DAY
+    recalled = correct[1:][same_card]
+
+    buckets = np.minimum(elapsed.astype(np.int64), max_days)
+    reviews = np.bincount(buckets, minlength=max_days + 1)
+    hits = np.bincount(buckets, weights=recalled, minlength=max_days + 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(reviews > 0, hits / reviews, np.nan)
+    return reviews, rate
+
+
+def card_ease(card, correct):
+    """ Share of correct answers per card. Returns (card_ids, reviews, ease) """
+    card_ids, inverse = np.unique(card, return_inverse=True)
+    reviews = np.bincount(inverse)
+    ease = np.bincount(inverse, weights=correct) / np.maximum(reviews, 1)
+    return card_ids, reviews, ease
+
+
+def forecast_due(card, reviewed_at, interval, now, days=7):
+    """ Cards falling due on each of the next `days` days, overdue cards count for today """
+    if card.size == 0:
+        return np.zeros(days, dtype=np.int64)
+
+    last_review = np.append(card[1:] != card[:-1], True)
+    due = reviewed_at[last_review] + interval[last_review] * DAY
+
+    today = (now + UTC_OFFSET) // DAY * DAY - UTC_OFFSET
+    offset = np.maximum((due - today) // DAY, 0).astype(np.int64)
+    return np.bincount(offset[offset < days], minlength=days)
+
+
+def streaks(reviewed_at, now):
+    """ (current, longest) run of consecutive local days with at least one review """
+    if reviewed_at.size == 0:
+        return 0, 0
+
+    days = np.unique((reviewed_at + UTC_OFFSET) // DAY)
+    breaks = np.flatnonzero(np.diff(days) != 1)
+    run_starts = np.concatenate(([0], breaks + 1))
+    run_ends = np.concatenate((breaks + 1, [days.size]))
+    longest = int((run_ends - run_starts).max())
+
+    today = (now + UTC_OFFSET) // DAY
+    current = int(run_ends[-1] - run_starts[-1]) if days[-1] >= today - 1 else 0
+    return current, longest
+
+
+def summarize(columns, now=None):
+    """ All /progress statistics for one user's event columns """
+    now = time.time() if now is None else now
+    card, reviewed_at, correct, interval = to_columns(columns)
+
+    reviews, rate = retention_curve(card, reviewed_at, correct)
+    card_ids, card_reviews, ease = card_ease(card, correct)
+    current_streak, longest_streak = streaks(reviewed_at, now)
+
+    def recall(first_day, last_day):
+        count = reviews[first_day:last_day + 1].sum()
+        hits = np.nansum(rate[first_day:last_day + 1] * reviews[first_day:last_day + 1])
+        return round(float(hits / count) * 100, 1) if count else None
+
+    weak = card_reviews >= 3
+    return {
+        "reviews": int(card.size),
+        "cards": int(card_ids.size),
+        "retention_1d": recall(0, 1),
+        "retention_7d": recall(2, 7),
+        "retention_30d": recall(8, 30),
+        "weak_cards": int((ease[weak] < 0.6).sum()),
+        "forecast": forecast_due(card, reviewed_at, interval, now).tolist(),
+        "current_streak": current_streak,
+        "longest_streak": longest_streak,
+    }
+
+
+def user_summary(user_id, fetch_events, now=None):
+    """ summarize() over the cached event columns of a user """
+    return summarize(load_events(user_id, fetch_events), now)
@@ -0,0 +1,85 @@
+""" Online snapshots of the live SQLite database: copied in small page steps, gzipped and rotated """
+import glob
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+import database
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_RETENTION = int(os.getenv("BACKUP_RETENTION", "7"))  # snapshots kept
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "256"))  # pages copied per step
+BACKUP_SLEEP = float(os.getenv("BACKUP_SLEEP", "0.005"))  # pause between steps, lets writers take the lock
+BACKUP_RESTARTS = int(os.getenv("BACKUP_RESTARTS", "3"))  # restarts of the stepped copy before copying in one step
+
+
+class _Restarted(Exception):
+    pass
+
+
+def _pause_between_steps(restarts):
+    """ progress= callback for Connection.backup: sleeps after every step and gives up after `restarts` restarts.
+
+    A write from another connection restarts the copy from the first page. The bot writes on every answer, so
+    on a busy database the stepped copy could start over forever.
+    """
+    state = {"remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > restarts:
+                raise _Restarted()
+        state["remaining"] = remaining
+        time.sleep(BACKUP_SLEEP)
+
+    return progress
+
+
+def create_snapshot(db_path=None, backup_dir=None, retention=None):
+    """ Snapshot the database without stopping the bot. Returns (snapshot path, seconds taken, compressed size) """
+    db_path = db_path or database.DB_NAME
+    backup_dir = backup_dir or BACKUP_DIR
+    retention = BACKUP_RETENTION if retention is None else retention
+    os.makedirs(backup_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    name = os.path.splitext(os.path.basename(db_path))[0]
+    snapshot = os.path.join(backup_dir, f"{name}-{datetime.now():%Y%m%d-%H%M%S-%f}.db.gz")
+
+    # Copy into a plain file first: the backup API needs a database to write to
+    fd, copy_path = tempfile.mkstemp(suffix=".db", dir=backup_dir)
+    os.close(fd)
+    try:
+        source = sqlite3.connect(db_path)
+        target = sqlite3.connect(copy_path)
+        try:
+            # Each step holds the read lock only for BACKUP_PAGES pages, user writes go through in between
+            try:
+                source.backup(target, pages=BACKUP_PAGES, progress=_pause_between_steps(BACKUP_RESTARTS))
+            except _Restarted:
+                # In WAL mode (see database.init_db) one step reads a single snapshot without blocking writers
+                source.backup(target)
+        finally:
+            target.close()
+            source.close()
+
+        with open(copy_path, "rb") as raw, gzip.open(snapshot + ".part", "wb", compresslevel=6) as compressed:
+            shutil.copyfileobj(raw, compressed, 1024 * 1024)
+        os.replace(snapshot + ".part", snapshot)
+    finally:
+        os.remove(copy_path)
+
+    rotate(backup_dir, name, retention)
+    return snapshot, time.perf_counter() - started, os.path.getsize(snapshot)
+
+
+def rotate(backup_dir, name, retention):
+    """ Delete the oldest snapshots so that only `retention` remain """
+    snapshots = sorted(glob.glob(os.path.join(backup_dir, f"{name}-*.db.gz")))
+    for old in snapshots[:max(0, len(snapshots) - retention)]:
+        os.remove(old)
@@ -0,0 +1,74 @@
+""" Startup benchmark: time from a fresh interpreter until the bot has answered its first update.
+
+The bot talks to the fake Bot API of bench_transport.py with no added latency, so the time is the bot's own:
+imports, storage setup, building the handlers, getMe, starting the JobQueue and handling one menu tap.
+
+    python bench_startup.py            # fails if the warm start exceeds STARTUP_BUDGET seconds (default 1.5)
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import bench_transport
+
+BUDGET = float(os.getenv("STARTUP_BUDGET", "1.5"))
+RUNS = int(os.getenv("STARTUP_RUNS", "5"))
+
+# Same order as Application.run_polling, with the first update handed over directly instead of polled
+SCRIPT = """
+import asyncio, time
+import main
+from telegram import Update
+
+async def first_update():
+    application = main.build_application()
+    await application.initialize()
+    await main.post_init(application)
+    await application.start()
+    update = {"update_id": 1, "message": {"message_id": 1, "date": 0, "text": "📚 Takrorlash",
+              "from": {"id": 1, "is_bot": False, "first_name": "Bench"}, "chat": {"id": 1, "type": "private"}}}
+    await application.process_update(Update.de_json(update, application.bot))
+    print(time.time(), flush=True)
+    await application.stop()
+    await application.shutdown()
+
+asyncio.run(first_update())
+"""
+
+
+def time_startup(env):
+    started = time.time()
+    result = subprocess.run([sys.executable, "-c", SCRIPT], env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+    return float(result.stdout.split()[-1]) - started
+
+
+def main():
+    bench_transport.LATENCY = 0
+    server = bench_transport.start_server()
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DB_NAME=os.path.join(directory, "bench.db"), BOT_TOKEN="0:bench",
+                   BOT_HTTP_VERSION="1.1", BOT_API_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}/bot")
+
+        cold = time_startup(env)  # creates and seeds the schema
+        warm = sorted(time_startup(env) for _ in range(RUNS))
+        median = warm[len(warm) // 2]
+    server.shutdown()
+
+    print(f"cold start to first update (new database): {cold:.3f}s")
+    print(f"warm start to first update (median of {RUNS}): {median:.3f}s, budget {BUDGET:.3f}s")
+
+    if median > BUDGET:
+        print("❌ Startup is over budget")
+        sys.exit(1)
+    print("✅ Startup is within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+""" Transport benchmark: quiz answers processed by the real handlers against a local fake Bot API server.
+
+The fake server answers every method after BENCH_API_LATENCY seconds, standing in for the round trip to
+api.telegram.org, so the per-answer time shows how many Bot API calls are awaited one after another.
+
+    python bench_transport.py          # BENCH_API_LATENCY=0.05 BENCH_ANSWERS=30 BENCH_USERS=20 by default
+"""
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+LATENCY = float(os.getenv("BENCH_API_LATENCY", "0.05"))
+ANSWERS = int(os.getenv("BENCH_ANSWERS", "30"))
+USERS = int(os.getenv("BENCH_USERS", "20"))  # users answering at the same time in the concurrency run
+
+_message_ids = itertools.count(1)
+_keyboards = {}  # chat id -> callback data of the last inline keyboard sent there
+
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real server
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8", "replace")
+        if "json" in self.headers.get("Content-Type", ""):
+            data = json.loads(body or "{}")
+        else:
+            data = {key: values[0] for key, values in parse_qs(body).items()}
+
+        time.sleep(LATENCY)
+
+        chat_id = int(data.get("chat_id") or 0)
+        markup = data.get("reply_markup")
+        if markup:
+            markup = json.loads(markup) if isinstance(markup, str) else markup
+            _keyboards[chat_id] = [button["callback_data"] for row in markup.get("inline_keyboard", [])
+                                   for button in row]
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = {"message_id": next(_message_ids), "date": 0, "text": data.get("text", ""),
+                      "chat": {"id": chat_id, "type": "private"}}
+        else:
+            result = True
+
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+_update_ids = itertools.count(1)
+
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"}
+
+
+def menu_message(user_id, text):
+    return {"update_id": next(_update_ids),
+            "message": {"message_id": next(_message_ids), "date": 0, "text": text, "from": user(user_id),
+                        "chat": {"id": user_id, "type": "private"}}}
+
+
+def quiz_tap(user_id):
+    return {"update_id": next(_update_ids),
+            "callback_query": {"id": str(next(_update_ids)), "chat_instance": "bench", "from": user(user_id),
+                               "data": _keyboards[user_id][0],
+                               "message": {"message_id": 1, "date": 0, "text": "?",
+                                           "chat": {"id": user_id, "type": "private"}}}}
+
+
+async def answer_quiz(application, user_id, answers):
+    """ Start quizzes and answer `answers` questions. Returns the seconds each answer took """
+    from telegram import Update
+
+    timings = []
+    while len(timings) < answers:
+        await application.process_update(Update.de_json(menu_message(user_id, "📚 Takrorlash"), application.bot))
+        for _ in range(min(10, answers - len(timings))):  # a quiz has up to 10 questions
+            started = time.perf_counter()
+            await application.process_update(Update.de_json(quiz_tap(user_id), application.bot))
+            timings.append(time.perf_counter() - started)
+    return timings
+
+
+async def run():
+    import main
+
+    application = main.build_application()
+    await application.initialize()
+    # The benchmark taps far faster than a person, flood control would drop most of it
+    main.flood_control.limits = {action: (10 ** 6, 10 ** 6) for action in main.flood_control.limits}
+
+    words = [(f"단어{i}", f"so'z {i}") for i in range(10)]
+    for user_id in range(1, USERS + 1):
+        main.store.add_flashcard(user_id, words)
+
+    timings = await answer_quiz(application, 1, ANSWERS)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(answer_quiz(application, user_id, 10) for user_id in range(1, USERS + 1)))
+    concurrent = time.perf_counter() - started
+
+    await application.shutdown()
+    return timings, concurrent
+
+
+def main():
+    server = start_server()
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.update(DB_NAME=os.path.join(directory, "bench.db"), BOT_TOKEN="0:bench", BOT_HTTP_VERSION="1.1",
+                          BOT_API_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}/bot")
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        timings, concurrent = asyncio.run(run())
+    server.shutdown()
+
+    timings.sort()
+    print(f"fake Bot API latency {LATENCY * 1000:.0f} ms per call")
+    print(f"per answer: median {statistics.median(timings) * 1000:.0f} ms, "
+          f"p95 {timings[int(len(timings) * 0.95) - 1] * 1000:.0f} ms over {len(timings)} answers")
+    print(f"{USERS} users x 10 answers: {concurrent:.2f}s, {USERS * 10 / concurrent:.0f} answers/s")
+
+
+if __name__ == "__main__":
+    main()
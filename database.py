@@ -1,7 +1,22 @@
-import sqlite3, random, json
-from datetime import datetime, timedelta
+import sqlite3, random, json, threading, time, os
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
 
-DB_NAME = "flashcards.db"
+DB_NAME = os.getenv("DB_NAME", "flashcards.db")
+
+# Bump when create_tables(), migrate() or the upgrade in init_db() change, so existing databases get upgraded once
+SCHEMA_VERSION = 9
+_schema_ready = False
+
+MATURE_INTERVAL = 21  # days between reviews from which a card counts as learned
+
+# The bot's day (daily challenges, scheduled jobs) follows Tashkent time whatever the host's timezone is
+TIMEZONE = ZoneInfo("Asia/Tashkent")
+
+# Review events are buffered in memory and written in batches
+REVIEW_EVENT_BATCH = 50
+_review_events = []
+_review_events_lock = threading.Lock()
 
 
 def create_tables():
@@ -52,16 +67,316 @@ def create_tables():
             )
             """)
 
+    # Append-only review history, one row per answered quiz question
+    cur.execute("""
+            CREATE TABLE IF NOT EXISTS review_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                flashcard_id INTEGER NOT NULL,
+                reviewed_at REAL NOT NULL,
+                correct INTEGER NOT NULL,
+                interval INTEGER NOT NULL
+            )
+            """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_review_events_user ON review_events (user_id, id)")
+
+    # Shared decks: the words are stored once, subscribers only get a scheduling row once they review a card
+    cur.execute("""
+            CREATE TABLE IF NOT EXISTS decks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE,
+                card_count INTEGER DEFAULT 0
+            )
+            """)
+    cur.execute("""
+            CREATE TABLE IF NOT EXISTS deck_cards (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                deck_id INTEGER NOT NULL REFERENCES decks (id),
+                korean TEXT NOT NULL,
+                uzbek TEXT NOT NULL
+            )
+            """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_deck_cards_deck ON deck_cards (deck_id)")
+    cur.execute("""
+            CREATE TABLE IF NOT EXISTS deck_subscriptions (
+                user_id INTEGER NOT NULL,
+                deck_id INTEGER NOT NULL REFERENCES decks (id),
+                subscribed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, deck_id)
+            ) WITHOUT ROWID
+            """)
+    cur.execute("""
+            CREATE TABLE IF NOT EXISTS deck_reviews (
+                user_id INTEGER NOT NULL,
+                card_id INTEGER NOT NULL REFERENCES deck_cards (id),
+                interval INTEGER DEFAULT 1,
+                correct_streak INTEGER DEFAULT 0,
+                last_reviewed TIMESTAMP,
+                next_review TIMESTAMP,
+                PRIMARY KEY (user_id, card_id)
+            ) WITHOUT ROWID
+            """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_deck_reviews_due ON deck_reviews (next_review)")
+
+    # Daily challenge words, picked off-peak for the next morning
+    cur.execute("""
+            CREATE TABLE IF NOT EXISTS daily_challenges (
+                user_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                card_ids TEXT NOT NULL,  -- JSON list of flashcard ids
+                score INTEGER,  -- NULL until the challenge is played
+                PRIMARY KEY (day, user_id)
+            ) WITHOUT ROWID
+            """)
+
     conn.commit()
     conn.close()
 
+    create_search_index()
+    create_deck_stats()
+
+
+def _owner(user_id):
+    """ Search token of a card owner. The closing 'u' keeps trigram matches for user 1 out of user 12's cards """
+    return f"u{user_id}u"
+
+
+def create_search_index():
+    """ Creates the FTS5 search tables over flashcards and keeps them in sync with triggers """
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_flashcards_user ON flashcards (user_id, korean)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_flashcards_user_id ON flashcards (user_id, id)")  # daily challenge seeks
+
+    # Tables from before the owner column index every user's cards together, so a short prefix query walked
+    # the matches of all users. Rebuild them
+    cur.execute("""
+        SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name IN ('flashcards_fts', 'flashcards_trigram')
+        """)
+    existing = set()
+    for table, sql in cur.fetchall():
+        if "owner" in sql:
+            existing.add(table)
+        else:
+            cur.execute(f"DROP TABLE {table}")
+            for trigger in ("ai", "ad", "au"):
+                cur.execute(f"DROP TRIGGER IF EXISTS {table}_{trigger}")
+
+    # Both tables are contentless (the text stays in flashcards) and carry the owner as an indexed token,
+    # so a query is ANDed with the user's own doclist inside the index instead of filtered afterwards
+
+    # Word index with prefix tables: handles short queries like "사" or "ol*"
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS flashcards_fts USING fts5(
+            owner, korean, uzbek,
+            content='',
+            tokenize='unicode61', prefix='1 2 3'
+        )
+        """)
+
+    # Trigram index: substring matches inside words (3+ characters)
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS flashcards_trigram USING fts5(
+            owner, korean, uzbek,
+            content='',
+            tokenize='trigram'
+        )
+        """)
+
+    owner = "'u' || {row}.user_id || 'u'"  # same as _owner()
+    for table in ("flashcards_fts", "flashcards_trigram"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON flashcards BEGIN
+                INSERT INTO {table} (rowid, owner, korean, uzbek)
+                VALUES (new.id, {owner.format(row="new")}, new.korean, new.uzbek);
+            END
+            """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON flashcards BEGIN
+                INSERT INTO {table} ({table}, rowid, owner, korean, uzbek)
+                VALUES ('delete', old.id, {owner.format(row="old")}, old.korean, old.uzbek);
+            END
+            """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_au AFTER UPDATE OF user_id, korean, uzbek ON flashcards BEGIN
+                INSERT INTO {table} ({table}, rowid, owner, korean, uzbek)
+                VALUES ('delete', old.id, {owner.format(row="old")}, old.korean, old.uzbek);
+                INSERT INTO {table} (rowid, owner, korean, uzbek)
+                VALUES (new.id, {owner.format(row="new")}, new.korean, new.uzbek);
+            END
+            """)
+
+        # Index the cards that existed before the search table was created
+        if table not in existing:
+            cur.execute(f"""
+                INSERT INTO {table} (rowid, owner, korean, uzbek)
+                SELECT id, {owner.format(row="flashcards")}, korean, uzbek FROM flashcards
+                """)
+
+    conn.commit()
+    conn.close()
+
+
+# Both card tables feed the statistics: owned flashcards and the user's rows for shared deck cards
+_SCHEDULED_CARDS = "SELECT user_id, interval, next_review FROM flashcards " \
+                   "UNION ALL SELECT user_id, interval, next_review FROM deck_reviews"
+# Cards of subscribed decks the user has not reviewed yet: due from the subscription date, without a schedule
+_UNSEEN_DECK_CARDS = """
+    SELECT s.user_id FROM deck_subscriptions s
+    JOIN deck_cards c ON c.deck_id = s.deck_id
+    LEFT JOIN deck_reviews r ON r.user_id = s.user_id AND r.card_id = c.id
+    WHERE r.card_id IS NULL
+"""
+_EXPECTED_STATS = f"""
+    SELECT user_id, SUM(scheduled), SUM(learning), SUM(mature), SUM(unseen) FROM (
+        SELECT user_id, 1 AS scheduled, COALESCE(interval, 1) < {MATURE_INTERVAL} AS learning,
+               COALESCE(interval, 1) >= {MATURE_INTERVAL} AS mature, 0 AS unseen
+        FROM ({_SCHEDULED_CARDS})
+        UNION ALL SELECT user_id, 0, 0, 0, 1 FROM ({_UNSEEN_DECK_CARDS})
+    ) GROUP BY user_id
+"""
+_EXPECTED_BUCKETS = f"""
+    SELECT user_id, COALESCE(substr(next_review, 1, 13), ''), COUNT(*)
+    FROM ({_SCHEDULED_CARDS}) GROUP BY 1, 2
+"""
+
+
+def _stats_change(row, sign):
+    """ Trigger body adding (sign 1) or removing (sign -1) the `row` card from the statistics tables """
+    return f"""
+        INSERT INTO deck_stats (user_id, total, learning, mature)
+        VALUES ({row}.user_id, {sign}, {sign} * (COALESCE({row}.interval, 1) < {MATURE_INTERVAL}),
+                {sign} * (COALESCE({row}.interval, 1) >= {MATURE_INTERVAL}))
+        ON CONFLICT (user_id) DO UPDATE SET total = total + excluded.total, learning = learning + excluded.learning,
+                                            mature = mature + excluded.mature;
+        INSERT INTO due_buckets (user_id, hour, cards)
+        VALUES ({row}.user_id, COALESCE(substr({row}.next_review, 1, 13), ''), {sign})
+        ON CONFLICT (user_id, hour) DO UPDATE SET cards = cards + excluded.cards;
+        DELETE FROM due_buckets
+        WHERE user_id = {row}.user_id AND hour = COALESCE(substr({row}.next_review, 1, 13), '') AND cards = 0;
+    """
+
+
+def _unseen_change(user_id, deck_id, sign):
+    """ Trigger statement adding (sign 1) or removing (sign -1) the deck's cards `user_id` has not reviewed """
+    return f"""
+        INSERT INTO deck_stats (user_id, unseen)
+        VALUES ({user_id}, {sign} * (SELECT COUNT(*) FROM deck_cards c WHERE c.deck_id = {deck_id} AND NOT EXISTS (
+            SELECT 1 FROM deck_reviews r WHERE r.user_id = {user_id} AND r.card_id = c.id)))
+        ON CONFLICT (user_id) DO UPDATE SET unseen = unseen + excluded.unseen;
+    """
+
+
+def _is_subscribed(row):
+    """ SQL condition: the `row` review belongs to a deck its user is subscribed to """
+    return f"""EXISTS (SELECT 1 FROM deck_subscriptions s JOIN deck_cards c ON c.deck_id = s.deck_id
+                       WHERE s.user_id = {row}.user_id AND c.id = {row}.card_id)"""
+
+
+def create_deck_stats():
+    """ Per-user card counts and due-hour buckets, kept current by triggers on the card and subscription tables """
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    cur.execute("PRAGMA table_info(deck_stats)")
+    columns = {row[1] for row in cur.fetchall()}
+    existing = bool(columns)
+    if existing and "unseen" not in columns:
+        cur.execute("ALTER TABLE deck_stats ADD COLUMN unseen INTEGER NOT NULL DEFAULT 0")
+        existing = False  # recount with the new column
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS deck_stats (
+            user_id INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            learning INTEGER NOT NULL DEFAULT 0,  -- interval below MATURE_INTERVAL days
+            mature INTEGER NOT NULL DEFAULT 0,
+            unseen INTEGER NOT NULL DEFAULT 0  -- subscribed deck cards never reviewed, not in the columns above
+        )
+        """)
+    # Cards by the hour their next review falls in ('YYYY-MM-DD HH', TIMEZONE wall time like next_review itself)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS due_buckets (
+            user_id INTEGER NOT NULL,
+            hour TEXT NOT NULL,
+            cards INTEGER NOT NULL,
+            PRIMARY KEY (user_id, hour)
+        ) WITHOUT ROWID
+        """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_due_buckets_hour ON due_buckets (hour)")
+
+    for table in ("flashcards", "deck_reviews"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_stats_ai AFTER INSERT ON {table} BEGIN
+                {_stats_change("new", 1)}
+            END
+            """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_stats_ad AFTER DELETE ON {table} BEGIN
+                {_stats_change("old", -1)}
+            END
+            """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_stats_au AFTER UPDATE OF user_id, interval, next_review ON {table} BEGIN
+                {_stats_change("old", -1)}
+                {_stats_change("new", 1)}
+            END
+            """)
+
+    # Unseen deck cards: added with a subscription or a new deck card, removed by the first review or unsubscribing.
+    # unsubscribe_deck deletes the subscription before the reviews, so those deletions find no subscription
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS deck_subscriptions_stats_ai AFTER INSERT ON deck_subscriptions BEGIN
+            {_unseen_change("new.user_id", "new.deck_id", 1)}
+        END
+        """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS deck_subscriptions_stats_ad AFTER DELETE ON deck_subscriptions BEGIN
+            {_unseen_change("old.user_id", "old.deck_id", -1)}
+        END
+        """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS deck_reviews_unseen_ai AFTER INSERT ON deck_reviews WHEN {_is_subscribed("new")}
+        BEGIN
+            UPDATE deck_stats SET unseen = unseen - 1 WHERE user_id = new.user_id;
+        END
+        """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS deck_reviews_unseen_ad AFTER DELETE ON deck_reviews WHEN {_is_subscribed("old")}
+        BEGIN
+            UPDATE deck_stats SET unseen = unseen + 1 WHERE user_id = old.user_id;
+        END
+        """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS deck_cards_stats_ai AFTER INSERT ON deck_cards BEGIN
+            INSERT INTO deck_stats (user_id, unseen)
+            SELECT user_id, 1 FROM deck_subscriptions WHERE deck_id = new.deck_id
+            ON CONFLICT (user_id) DO UPDATE SET unseen = unseen + 1;
+        END
+        """)
+
+    # Count the cards that existed before the statistics tables
+    if not existing:
+        _rebuild_deck_stats(cur)
+
+    conn.commit()
+    conn.close()
+
+
+def _rebuild_deck_stats(cur):
+    cur.execute("DELETE FROM deck_stats")
+    cur.execute("DELETE FROM due_buckets")
+    cur.execute(f"INSERT INTO deck_stats (user_id, total, learning, mature, unseen) {_EXPECTED_STATS}")
+    cur.execute(f"INSERT INTO due_buckets (user_id, hour, cards) {_EXPECTED_BUCKETS}")
+
 
 # Call the function to add grammar rules
 def add_flashcard(user_id, words):
     """ Adds multiple flashcards and updates user progress """
     conn = sqlite3.connect(DB_NAME)
     cur = conn.cursor()
-    next_review = datetime.now()  # Review immediately
+    next_review = local_now()  # Review immediately
 
     # Insert words as a batch
     cur.executemany("INSERT INTO flashcards (user_id, korean, uzbek, next_review) VALUES (?, ?, ?, ?)",
@@ -95,6 +410,16 @@ def word_exists(user_id, korean):
     return exists
 
 
+def get_user_words(user_id):
+    """ All Korean words in a user's deck """
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+    cur.execute("SELECT korean FROM flashcards WHERE user_id = ?", (user_id,))
+    words = [row[0] for row in cur.fetchall()]
+    conn.close()
+    return words
+
+
 def add_user(user_id):
     """ Insert a new user into the user_progress table if not exists. """
     conn = sqlite3.connect(DB_NAME)
@@ -114,19 +439,32 @@ def add_user(user_id):
     conn.close()
 
 
+def is_shared_card(card_id):
+    """ Cards from shared decks are handed out with negative ids, owned flashcards keep their own id """
+    return card_id < 0
+
+
 def get_due_flashcard(user_id, limit=10):
     """ Fetch flashcards for review. Ensure they can be reviewed multiple times a day. """
     conn = sqlite3.connect(DB_NAME)
     cur = conn.cursor()
 
+    # Owned cards and cards of subscribed decks; a deck card never reviewed counts from the subscription date.
+    # All three timestamps are CURRENT_TIMESTAMP values, so they compare as one clock
     cur.execute("""
-        SELECT id, korean, uzbek FROM flashcards
-        WHERE user_id = ? 
-        ORDER BY last_reviewed ASC 
+        SELECT id, korean, uzbek, last_reviewed FROM flashcards
+        WHERE user_id = ?
+        UNION ALL
+        SELECT -c.id, c.korean, c.uzbek, COALESCE(r.last_reviewed, s.subscribed_at)
+        FROM deck_subscriptions s
+        JOIN deck_cards c ON c.deck_id = s.deck_id
+        LEFT JOIN deck_reviews r ON r.user_id = s.user_id AND r.card_id = c.id
+        WHERE s.user_id = ?
+        ORDER BY 4 ASC
         LIMIT ?
-    """, (user_id, limit))
+    """, (user_id, user_id, limit))
 
-    flashcards = cur.fetchall()
+    flashcards = [(card_id, korean, uzbek) for card_id, korean, uzbek, _ in cur.fetchall()]
     conn.close()
 
     return flashcards
@@ -137,10 +475,14 @@ def get_users_with_due_flashcards():
     conn = sqlite3.connect(DB_NAME)
     cur = conn.cursor()
 
+    # Scheduled cards come from the due-hour buckets; subscribers with deck cards they never reviewed are due too
     cur.execute("""
-    SELECT DISTINCT user_id FROM flashcards 
-    WHERE next_review <= CURRENT_TIMESTAMP
-    """)
+    SELECT user_id FROM due_buckets
+    WHERE hour <= ?
+    UNION
+    SELECT user_id FROM deck_stats
+    WHERE unseen > 0
+    """, (local_now().strftime("%Y-%m-%d %H"),))
 
     users = [row[0] for row in cur.fetchall()]
     conn.close()
@@ -163,19 +505,145 @@ def get_random_words(user_id, limit=3):
     return result
 
 
-def get_random_wrong_answers(correct_answer, limit=3):
-    """Fetches random incorrect answers from the database."""
+def local_now():
+    """ Naive wall-clock time in TIMEZONE: next_review values and the due-hour buckets are in this clock """
+    return datetime.now(TIMEZONE).replace(tzinfo=None)
+
+
+def local_today():
+    """ Today's date in TIMEZONE as 'YYYY-MM-DD', the key of daily challenges """
+    return local_now().date().isoformat()
+
+
+def generate_daily_challenges(day=None, size=3, keep_days=7):
+    """ Pick `size` random cards for every user with cards. Returns the number of users """
+    day = day or local_today()
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    # Random id seeks on each user's (user_id, id) index: a few index lookups per user instead of reading every
+    # card. Cards that follow a long run of other users' ids are picked somewhat more often
+    users = cur.execute("""
+        WITH RECURSIVE users(user_id) AS (
+            SELECT MIN(user_id) FROM flashcards
+            UNION ALL
+            SELECT (SELECT MIN(user_id) FROM flashcards WHERE user_id > users.user_id) FROM users
+            WHERE users.user_id IS NOT NULL
+        )
+        SELECT user_id FROM users WHERE user_id IS NOT NULL
+    """).fetchall()
+
+    challenges = {}
+    for user_id, in users:
+        first = [card_id for card_id, in cur.execute(
+            "SELECT id FROM flashcards WHERE user_id = ? ORDER BY id LIMIT ?", (user_id, size + 1))]
+        if len(first) <= size:
+            challenges[user_id] = first
+            continue
+
+        last = cur.execute("SELECT MAX(id) FROM flashcards WHERE user_id = ?", (user_id,)).fetchone()[0]
+        picked = []
+        for _ in range(size * 4):
+            cur.execute("SELECT id FROM flashcards WHERE user_id = ? AND id >= ? ORDER BY id LIMIT 1",
+                        (user_id, random.randint(first[0], last)))
+            card_id = cur.fetchone()[0]
+            if card_id not in picked:
+                picked.append(card_id)
+                if len(picked) == size:
+                    break
+        # Seeks kept landing on the same cards: fill up with the user's first cards
+        picked += [card_id for card_id in first if card_id not in picked][:size - len(picked)]
+        challenges[user_id] = picked
+
+    cur.executemany("INSERT OR REPLACE INTO daily_challenges (user_id, day, card_ids, score) VALUES (?, ?, ?, NULL)",
+                    [(user_id, day, json.dumps(card_ids)) for user_id, card_ids in challenges.items()])
+    cur.execute("DELETE FROM daily_challenges WHERE day < ?",
+                ((date.fromisoformat(day) - timedelta(days=keep_days)).isoformat(),))
+
+    conn.commit()
+    conn.close()
+    return len(challenges)
+
+
+def get_daily_challenge(user_id, day=None):
+    """ Today's challenge of a user as ([(id, korean, uzbek)], score), or None if none was generated """
+    day = day or local_today()
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    cur.execute("SELECT card_ids, score FROM daily_challenges WHERE day = ? AND user_id = ?", (day, user_id))
+    row = cur.fetchone()
+    if row is None:
+        conn.close()
+        return None
+
+    card_ids = json.loads(row[0])
+    cur.execute(f"SELECT id, korean, uzbek FROM flashcards WHERE id IN ({','.join('?' * len(card_ids))})", card_ids)
+    cards = cur.fetchall()
+    conn.close()
+    return cards, row[1]
+
+
+def get_daily_challenges(day=None):
+    """ Korean words of every unplayed challenge of the day: {user_id: [korean, ...]} """
+    day = day or local_today()
     conn = sqlite3.connect(DB_NAME)
     cur = conn.cursor()
 
     cur.execute("""
-        SELECT DISTINCT uzbek FROM flashcards 
-        WHERE uzbek != ? 
-        ORDER BY RANDOM() 
-        LIMIT ?
-    """, (correct_answer, limit))
+        SELECT d.user_id, f.korean FROM daily_challenges d, json_each(d.card_ids) j
+        JOIN flashcards f ON f.id = j.value
+        WHERE d.day = ? AND d.score IS NULL
+    """, (day,))
+
+    challenges = {}
+    for user_id, korean in cur.fetchall():
+        challenges.setdefault(user_id, []).append(korean)
+    conn.close()
+    return challenges
+
+
+def complete_daily_challenge(user_id, day, score):
+    """ Store the score once. Returns False if the challenge was already played """
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+    cur.execute("UPDATE daily_challenges SET score = ? WHERE day = ? AND user_id = ? AND score IS NULL",
+                (score, day, user_id))
+    completed = cur.rowcount == 1
+    conn.commit()
+    conn.close()
+    return completed
+
+
+def get_random_wrong_answers(correct_answer, limit=3, card_id=None):
+    """ Fetches random incorrect answers from the database.
+
+    A shared deck card (negative `card_id`) takes them from its own deck first, so deck-only users are not
+    shown translations of unrelated words.
+    """
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    wrong_answers = []
+    if card_id is not None and is_shared_card(card_id):
+        cur.execute("""
+            SELECT DISTINCT other.uzbek FROM deck_cards card
+            JOIN deck_cards other ON other.deck_id = card.deck_id
+            WHERE card.id = ? AND other.uzbek != ?
+            ORDER BY RANDOM()
+            LIMIT ?
+        """, (-card_id, correct_answer, limit))
+        wrong_answers = [row[0] for row in cur.fetchall()]
+
+    if len(wrong_answers) < limit:
+        cur.execute("""
+            SELECT DISTINCT uzbek FROM flashcards 
+            WHERE uzbek != ? 
+            ORDER BY RANDOM() 
+            LIMIT ?
+        """, (correct_answer, limit))
+        wrong_answers += [row[0] for row in cur.fetchall() if row[0] not in wrong_answers][:limit - len(wrong_answers)]
 
-    wrong_answers = [row[0] for row in cur.fetchall()]
     conn.close()
 
     if len(wrong_answers) >= limit:
@@ -208,6 +676,56 @@ def get_user_progress(user_id):
     return 0, 0, 0, 0  # Default if no data
 
 
+def get_deck_stats(user_id, now=None):
+    """ (total, learning, mature, due now, due today) of the user's cards, from the materialized tables.
+
+    Due times are compared by the hour: a card due later in the current hour already counts as due now.
+    Deck cards the user has not reviewed yet are learning and due now, like get_due_flashcard hands them out.
+    """
+    now = now or local_now()
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    cur.execute("""
+        SELECT s.total + s.unseen, s.learning + s.unseen, s.mature,
+               COALESCE(SUM(CASE WHEN b.hour <= ? THEN b.cards END), 0) + s.unseen, COALESCE(SUM(b.cards), 0) + s.unseen
+        FROM deck_stats s
+        LEFT JOIN due_buckets b ON b.user_id = s.user_id AND b.hour <= ?
+        WHERE s.user_id = ?
+    """, (now.strftime("%Y-%m-%d %H"), now.strftime("%Y-%m-%d 23"), user_id))
+
+    result = cur.fetchone()
+    conn.close()
+    return result if result[0] is not None else (0, 0, 0, 0, 0)
+
+
+def check_deck_stats(repair=False):
+    """ Compare the statistics tables with a full recount. Returns the number of users that differ """
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    stored_stats = "SELECT user_id, total, learning, mature, unseen FROM deck_stats " \
+                   "WHERE total OR learning OR mature OR unseen"
+    stored_buckets = "SELECT user_id, hour, cards FROM due_buckets WHERE cards != 0"
+    cur.execute(f"""
+        SELECT COUNT(DISTINCT user_id) FROM (
+            SELECT user_id FROM ({_EXPECTED_STATS} EXCEPT {stored_stats})
+            UNION ALL SELECT user_id FROM ({stored_stats} EXCEPT {_EXPECTED_STATS})
+            UNION ALL SELECT user_id FROM ({_EXPECTED_BUCKETS} EXCEPT {stored_buckets})
+            UNION ALL SELECT user_id FROM ({stored_buckets} EXCEPT {_EXPECTED_BUCKETS})
+        )
+    """)
+    mismatched = cur.fetchone()[0]
+
+    if mismatched and repair:
+        _rebuild_deck_stats(cur)
+        conn.commit()
+        print(f"Deck statistics rebuilt: {mismatched} users were out of date.")
+
+    conn.close()
+    return mismatched
+
+
 def get_top_users(limit=10):
     """ Fetch top users sorted by score """
     conn = sqlite3.connect(DB_NAME)
@@ -242,33 +760,68 @@ def update_user_score(user_id, username, points):
     conn.close()
 
 
-def update_flashcard_review(flashcard_id, correct):
+def update_flashcard_review(flashcard_id, correct, user_id=None):
     """ Update flashcard interval and next review date. """
+    if is_shared_card(flashcard_id):
+        return update_deck_review(user_id, -flashcard_id, correct)
+
     conn = sqlite3.connect(DB_NAME)
     cur = conn.cursor()
 
+    cur.execute("SELECT interval, correct_streak FROM flashcards WHERE id = ?", (flashcard_id,))
+    result = cur.fetchone()
+    if result is None:
+        conn.close()
+        return 1
+
+    interval, correct_streak = result
     if correct:
-        cur.execute("""
-                UPDATE flashcards 
-                SET last_reviewed = date('now'), 
-                    correct_streak = correct_streak + 1,
-                    interval = CASE 
-                        WHEN correct_streak >= 5 THEN interval * 2  -- Increase more if very familiar
-                        ELSE interval + 1  -- Increase normally
-                    END
-                WHERE id = ?
-            """, (flashcard_id,))
+        interval = interval * 2 if correct_streak >= 5 else interval + 1  # Increase more if very familiar
+        correct_streak += 1
     else:
-        cur.execute("""
-                UPDATE flashcards 
-                SET last_reviewed = date('now'), 
-                    correct_streak = 0,  -- Reset streak
-                    interval = 1  -- Reset interval
-                WHERE id = ?
-            """, (flashcard_id,))
+        interval, correct_streak = 1, 0  # Reset streak and interval
+
+    # One UPDATE, so flashcards_stats_au moves the card between due buckets once per answer
+    cur.execute("""
+            UPDATE flashcards
+            SET last_reviewed = CURRENT_TIMESTAMP, correct_streak = ?, interval = ?, next_review = ?
+            WHERE id = ?
+        """, (correct_streak, interval, local_now() + timedelta(days=interval), flashcard_id))
+
+    conn.commit()
+    conn.close()
+
+    return interval
+
+
+def update_deck_review(user_id, card_id, correct):
+    """ Same schedule as owned flashcards, kept in the user's deck_reviews row (created on first review) """
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    cur.execute("SELECT interval, correct_streak FROM deck_reviews WHERE user_id = ? AND card_id = ?",
+                (user_id, card_id))
+    interval, correct_streak = cur.fetchone() or (1, 0)
+
+    if correct:
+        interval = interval * 2 if correct_streak >= 5 else interval + 1
+        correct_streak += 1
+    else:
+        interval, correct_streak = 1, 0
+
+    # An upsert, not INSERT OR REPLACE: the replace would delete the old row without firing the stats triggers.
+    # last_reviewed uses CURRENT_TIMESTAMP like owned cards and subscribed_at, get_due_flashcard sorts them together
+    cur.execute("""
+        INSERT INTO deck_reviews (user_id, card_id, interval, correct_streak, last_reviewed, next_review)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?)
+        ON CONFLICT (user_id, card_id) DO UPDATE SET
+            interval = excluded.interval, correct_streak = excluded.correct_streak,
+            last_reviewed = excluded.last_reviewed, next_review = excluded.next_review
+    """, (user_id, card_id, interval, correct_streak, local_now() + timedelta(days=interval)))
 
     conn.commit()
     conn.close()
+    return interval
 
 
 def update_difficulty(flashcard_id, difficulty):
@@ -287,7 +840,7 @@ def update_difficulty(flashcard_id, difficulty):
     # Update interval based on difficulty (double for "Easy")
     new_interval = current_interval * 2 if difficulty == 3 else review_intervals[difficulty]
 
-    next_review = datetime.now() + timedelta(days=new_interval)
+    next_review = local_now() + timedelta(days=new_interval)
 
     cur.execute("""
         UPDATE flashcards 
@@ -358,6 +911,154 @@ def track_review(user_id, is_correct):
     conn.close()
 
 
+def _fts_query(text, prefix):
+    """ Quotes every token of a user query so FTS5 operators are matched literally """
+    tokens = ['"' + token.replace('"', '""') + '"' for token in text.split()]
+    if prefix:
+        tokens = [token + "*" for token in tokens]
+    return " ".join(tokens)
+
+
+def search_flashcards(user_id, text, page=0, per_page=10):
+    """ Search a user's flashcards in both languages. Returns (cards, total_pages) """
+    text = text.strip()
+    if not text:
+        return [], 0
+
+    # Trigram matches substrings but needs 3+ characters per token, shorter queries use prefix search
+    if all(len(token) >= 3 for token in text.split()):
+        table, match = "flashcards_trigram", _fts_query(text, prefix=False)
+    else:
+        table, match = "flashcards_fts", _fts_query(text, prefix=True)
+
+    # Only the user's cards: their owner token is ANDed into the query, so the cost follows the user's own deck
+    match = f'owner:"{_owner(user_id)}" AND {{korean uzbek}}: ({match})'
+
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    cur.execute(f"SELECT COUNT(*) FROM {table} WHERE {table} MATCH ?", (match,))
+    total = cur.fetchone()[0]
+
+    cur.execute(f"""
+        SELECT f.id, f.korean, f.uzbek FROM {table}
+        CROSS JOIN flashcards f ON f.id = {table}.rowid
+        WHERE {table} MATCH ?
+        ORDER BY {table}.rank
+        LIMIT ? OFFSET ?
+    """, (match, per_page, page * per_page))
+
+    cards = cur.fetchall()
+    conn.close()
+
+    total_pages = (total - 1) // per_page + 1 if total else 0
+    return cards, total_pages
+
+
+# Review history
+
+def log_review_event(user_id, flashcard_id, correct, interval):
+    """ Queue a review event; the queue is written to the database in batches """
+    with _review_events_lock:
+        _review_events.append((user_id, flashcard_id, time.time(), 1 if correct else 0, interval))
+        full = len(_review_events) >= REVIEW_EVENT_BATCH
+
+    if full:
+        flush_review_events()
+
+
+def flush_review_events():
+    """ Write all queued review events in one transaction """
+    global _review_events
+    with _review_events_lock:
+        events, _review_events = _review_events, []
+
+    if not events:
+        return
+
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+    cur.executemany("""
+        INSERT INTO review_events (user_id, flashcard_id, reviewed_at, correct, interval)
+        VALUES (?, ?, ?, ?, ?)
+    """, events)
+    conn.commit()
+    conn.close()
+
+
+def get_review_events(user_id, after_id=0):
+    """ Review events of a user newer than `after_id` as (id, flashcard_id, reviewed_at, correct, interval) rows """
+    flush_review_events()
+
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, flashcard_id, reviewed_at, correct, interval FROM review_events
+        WHERE user_id = ? AND id > ?
+        ORDER BY id
+    """, (user_id, after_id))
+    events = cur.fetchall()
+    conn.close()
+    return events
+
+
+# Shared decks
+
+def create_deck(name, words):
+    """ Create a shared deck (or extend an existing one with the same name). Returns the deck id """
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    cur.execute("INSERT INTO decks (name) VALUES (?) ON CONFLICT(name) DO NOTHING", (name,))
+    cur.execute("SELECT id FROM decks WHERE name = ?", (name,))
+    deck_id = cur.fetchone()[0]
+
+    cur.executemany("INSERT INTO deck_cards (deck_id, korean, uzbek) VALUES (?, ?, ?)",
+                    [(deck_id, korean, uzbek) for korean, uzbek in words])
+    cur.execute("UPDATE decks SET card_count = card_count + ? WHERE id = ?", (len(words), deck_id))
+
+    conn.commit()
+    conn.close()
+    return deck_id
+
+
+def get_decks(user_id):
+    """ All shared decks as (id, name, card_count, subscribed) """
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+
+    cur.execute("""
+        SELECT d.id, d.name, d.card_count, s.user_id IS NOT NULL FROM decks d
+        LEFT JOIN deck_subscriptions s ON s.deck_id = d.id AND s.user_id = ?
+        ORDER BY d.name
+    """, (user_id,))
+
+    decks = [(deck_id, name, card_count, bool(subscribed)) for deck_id, name, card_count, subscribed in cur.fetchall()]
+    conn.close()
+    return decks
+
+
+def subscribe_deck(user_id, deck_id):
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+    cur.execute("INSERT OR IGNORE INTO deck_subscriptions (user_id, deck_id) VALUES (?, ?)", (user_id, deck_id))
+    conn.commit()
+    conn.close()
+
+
+def unsubscribe_deck(user_id, deck_id):
+    """ Remove the subscription together with the user's scheduling rows for that deck """
+    conn = sqlite3.connect(DB_NAME)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM deck_subscriptions WHERE user_id = ? AND deck_id = ?", (user_id, deck_id))
+    cur.execute("""
+        DELETE FROM deck_reviews
+        WHERE user_id = ? AND card_id IN (SELECT id FROM deck_cards WHERE deck_id = ?)
+    """, (user_id, deck_id))
+    conn.commit()
+    conn.close()
+
+
 # Grammar Logic
 
 def get_grammar_rules_by_level(level):
@@ -396,24 +1097,56 @@ grammar_rules = [
 ]
 
 def migrate():
+    """ Bring older databases up to date: missing flashcard columns, review timestamps and the grammar seed data """
     conn = sqlite3.connect(DB_NAME)
     cur = conn.cursor()
 
-    # Add the correct_streak column if it doesn't exist
-    try:
+    # Columns that were added to flashcards after the first release
+    cur.execute("PRAGMA table_info(flashcards)")
+    columns = {row[1] for row in cur.fetchall()}
+    for column in ("correct_streak", "review_count", "correct_count"):
+        if column not in columns:
+            cur.execute(f"ALTER TABLE flashcards ADD COLUMN {column} INTEGER DEFAULT 0")
+            print(f"Migration successful: Added '{column}' column.")
+
+    # last_reviewed used to be a bare date for owned cards and host-local time for deck cards; make both
+    # CURRENT_TIMESTAMP values ('YYYY-MM-DD HH:MM:SS' UTC), as subscribed_at already is
+    cur.execute("UPDATE flashcards SET last_reviewed = datetime(last_reviewed) WHERE length(last_reviewed) = 10")
+    cur.execute("""
+        UPDATE deck_reviews SET last_reviewed = datetime(last_reviewed, 'utc') WHERE length(last_reviewed) > 19
+        """)
+
+    # Seed grammar rules only once
+    cur.execute("SELECT COUNT(*) FROM grammar")
+    if cur.fetchone()[0] == 0:
         cur.executemany('''
 INSERT INTO grammar (level, title, explanation, examples) 
                         VALUES
                         (?, ?, ?, ?)''', grammar_rules)
-        print("Migration successful: Added 'correct_count' column.")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            print("Column 'correct_count' already exists. Skipping migration.")
-        else:
-            raise e
 
     conn.commit()
     cur.close()
     conn.close()
 
-migrate()
\ No newline at end of file
+
+def init_db():
+    """ Create and migrate the schema. Once the file is at SCHEMA_VERSION this is a single PRAGMA read """
+    global _schema_ready
+    if _schema_ready:
+        return
+
+    conn = sqlite3.connect(DB_NAME)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+
+    if version < SCHEMA_VERSION:
+        create_tables()
+        migrate()
+
+        conn = sqlite3.connect(DB_NAME)
+        # Stored in the file: readers (the page-stepped backup among them) no longer block writers
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.close()
+
+    _schema_ready = True
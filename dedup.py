@@ -0,0 +1,70 @@
+""" Idempotency layer: drops redelivered updates and repeated taps on the same quiz question """
+import time
+from collections import OrderedDict
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+TTL = 10 * 60  # seconds a seen key is remembered
+MAX_KEYS = 50_000
+
+
+class TTLCache:
+    """ Bounded set of recently seen keys, oldest evicted first """
+
+    def __init__(self, ttl=TTL, max_keys=MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._seen = OrderedDict()  # key -> time first seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    def add(self, key, now=None):
+        """ Remember `key`. Returns False if it was already seen within the TTL """
+        now = time.monotonic() if now is None else now
+
+        # Keys are inserted in time order, so expired ones are at the front
+        while self._seen:
+            oldest, seen_at = next(iter(self._seen.items()))
+            if now - seen_at <= self.ttl and len(self._seen) < self.max_keys:
+                break
+            del self._seen[oldest]
+
+        if key in self._seen:
+            return False
+        self._seen[key] = now
+        return True
+
+
+def parse_quiz_answer(data):
+    """ 'quiz:<session>:<question>:<option>' -> (session, question, option), or None for other callbacks """
+    parts = data.split(":") if data else []
+    if len(parts) != 4 or parts[0] != "quiz" or not parts[2].isdigit() or not parts[3].isdigit():
+        return None
+    return parts[1], int(parts[2]), int(parts[3])
+
+
+class Deduplicator:
+    """ Callback for a TypeHandler in the last pre-handler group, after flood control has let the update through """
+
+    def __init__(self, ttl=TTL, max_keys=MAX_KEYS):
+        self.updates = TTLCache(ttl, max_keys)  # update_id
+        self.answers = TTLCache(ttl, max_keys)  # (user_id, quiz session, question)
+        self.duplicate_updates = 0
+        self.duplicate_answers = 0
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not self.updates.add(update.update_id):
+            self.duplicate_updates += 1
+            raise ApplicationHandlerStop
+
+        query = update.callback_query
+        answer = parse_quiz_answer(query.data) if query else None
+        if answer is None:
+            return
+
+        session, question, _ = answer
+        if not self.answers.add((query.from_user.id, session, question)):
+            self.duplicate_answers += 1
+            await query.answer()
+            raise ApplicationHandlerStop
@@ -0,0 +1,144 @@
+""" Offline Korean–Uzbek dictionary in a sorted, memory-mapped binary file.
+
+File layout (little-endian):
+    b"KUDICT1\\n"              magic
+    uint32 count, uint32 0     header
+    uint32 offsets[count + 1]  record start offsets inside the data block
+    data                       records b"korean\\tuzbek", sorted by the korean UTF-8 bytes
+
+Lookups are a binary search straight over the mapped pages: nothing is parsed at startup and the
+pages are shared by every process that maps the same file.
+
+    python dictionary.py build ko_uz.tsv data/ko_uz.dict
+    python dictionary.py bench data/ko_uz.dict
+"""
+import mmap
+import os
+import struct
+import sys
+import time
+import unicodedata
+
+DICTIONARY_PATH = os.getenv("DICTIONARY_PATH", os.path.join("data", "ko_uz.dict"))
+
+MAGIC = b"KUDICT1\n"
+HEADER = struct.Struct("<8sII")
+OFFSET = struct.Struct("<I")
+
+_dictionary = None
+
+
+def normalize(word):
+    return unicodedata.normalize("NFC", word.strip())
+
+
+class Dictionary:
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, _ = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or sys.byteorder != "little":
+            self._map.close()
+            raise ValueError(f"{path} is not a dictionary file or this host is not little-endian")
+        self._data = HEADER.size + OFFSET.size * (self.count + 1)
+        # Zero-copy view of the offset table (the file is little-endian, like the hosts we run on)
+        self._offsets = memoryview(self._map)[HEADER.size:self._data].cast("I")
+
+    def __len__(self):
+        return self.count
+
+    def _key(self, index):
+        start = self._data + self._offsets[index]
+        return self._map[start:self._map.find(b"\t", start)]
+
+    def lookup(self, word):
+        """ Uzbek translation of a Korean word, or None """
+        key = normalize(word).encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            korean = self._key(middle)
+            if korean < key:
+                low = middle + 1
+            elif korean > key:
+                high = middle
+            else:
+                start = self._data + self._offsets[middle] + len(korean) + 1
+                return self._map[start:self._data + self._offsets[middle + 1]].decode("utf-8")
+        return None
+
+    def close(self):
+        self._offsets.release()
+        self._map.close()
+
+
+def get_dictionary():
+    """ The bundled dictionary, mapped on first use. None when the file is not installed """
+    global _dictionary
+    if _dictionary is None and os.path.exists(DICTIONARY_PATH):
+        _dictionary = Dictionary(DICTIONARY_PATH)
+    return _dictionary
+
+
+def build(source, target):
+    """ Convert a `korean<TAB>uzbek` TSV file into the binary format. Returns the number of entries """
+    entries = {}
+    with open(source, encoding="utf-8") as file:
+        for line in file:
+            korean, _, uzbek = line.rstrip("\n").partition("\t")
+            korean, uzbek = normalize(korean), uzbek.strip()
+            if not korean or not uzbek:
+                continue
+            # Several lines for one word are merged into one translation
+            if korean in entries and uzbek not in entries[korean].split("; "):
+                entries[korean] += "; " + uzbek
+            else:
+                entries.setdefault(korean, uzbek)
+
+    records = sorted((korean.encode("utf-8"), uzbek.encode("utf-8")) for korean, uzbek in entries.items())
+
+    offsets, position = [], 0
+    for korean, uzbek in records:
+        offsets.append(position)
+        position += len(korean) + 1 + len(uzbek)
+    offsets.append(position)
+
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    with open(target + ".part", "wb") as file:
+        file.write(HEADER.pack(MAGIC, len(records), 0))
+        file.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        for korean, uzbek in records:
+            file.write(korean + b"\t" + uzbek)
+    os.replace(target + ".part", target)
+    return len(records)
+
+
+def bench(path, lookups=100_000):
+    """ Lookups per second for a mix of words that exist and words that don't """
+    dictionary = Dictionary(path)
+    if not dictionary.count:
+        print("The dictionary is empty")
+        return
+
+    step = max(1, dictionary.count // 1000)
+    words = [dictionary._key(i).decode("utf-8") for i in range(0, dictionary.count, step)]
+    words += [word + "없" for word in words]
+
+    started = time.perf_counter()
+    found = sum(dictionary.lookup(words[i % len(words)]) is not None for i in range(lookups))
+    elapsed = time.perf_counter() - started
+
+    print(f"{dictionary.count} entries, {lookups} lookups ({found} found) in {elapsed:.3f}s: "
+          f"{lookups / elapsed:,.0f} lookups/s")
+    dictionary.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "build":
+        print(f"✅ {build(sys.argv[2], sys.argv[3])} entries written to {sys.argv[3]}")
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "bench":
+        bench(sys.argv[2], *(int(arg) for arg in sys.argv[3:]))
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -1,13 +1,15 @@
 import logging
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, ContextTypes, CommandHandler, filters, MessageHandler, CallbackQueryHandler, \
-    ConversationHandler
-from apscheduler.schedulers.background import BackgroundScheduler
-import os, database, tempfile
+from telegram.ext import Application, ContextTypes, CommandHandler, filters, MessageHandler, \
+    ConversationHandler, TypeHandler
+import asyncio
+from datetime import datetime, time
+import os, backup, dedup, profiler, router, sessions, similarity, storage, tempfile, throttle, transport
+import dictionary as ko_uz_dictionary
+from database import TIMEZONE, local_today
 import random
+import uuid
 from dotenv import load_dotenv
-from gtts import gTTS
-import signal
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -15,13 +17,26 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
 # States for buttons
 PRONOUNCE = 1
 ADD_WORD = 2
 REVIEW_TEXT = 3
 FEEDBACK = 4
 
+CHALLENGE_POINTS = 10  # Leaderboard bonus per correct daily challenge answer
 
+store = storage.get_storage()
+deduplicator = dedup.Deduplicator()
+flood_control = throttle.FloodControl()
+session_manager = sessions.SessionManager()
+
+# Callback data is "<feature>:<action>:<arguments>", menu buttons are routed on their label
+callbacks = router.Router("callback", separator=router.SEPARATOR)
+menu = router.Router("menu")
+
+
+@menu.route("🔙 Orqaga")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ Sends a menu with buttons instead of requiring text commands. """
     try:
@@ -42,32 +57,31 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """ Handle button-based commands instead of text commands. """
-    text = update.message.text.strip()
+    """ Text that is neither a menu button nor part of a conversation """
+    await update.message.reply_text("⚠️ Noto‘g‘ri tanlov. Tugmalardan birini tanlang.")
+
+
+@menu.route("📚 Takrorlash")
+async def open_review(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await review_word(update, context)
+    return REVIEW_TEXT
+
+
+@menu.route("➕ So'z qo'shish")
+async def open_add_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [[InlineKeyboardButton("❌ Bekor qilish", callback_data="add_word:cancel")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    prompt = "📝 Yangi so‘zni quyidagi formatda yuboring:\n`한국어 - Oʻzbekcha`\n"
+    if ko_uz_dictionary.get_dictionary():
+        prompt += "yoki faqat `한국어` — tarjima lug‘atdan olinadi.\n"
+    await update.message.reply_text(prompt + "\n❌ Bekor qilish uchun tugmani bosing.", reply_markup=reply_markup)
+    return ADD_WORD
 
-    if text == "📚 Takrorlash":
-        await review_word(update, context)
-        return REVIEW_TEXT
-    elif text == "➕ So'z qo'shish":
-        keyboard = [[InlineKeyboardButton("❌ Bekor qilish", callback_data="cancel_add_word")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("📝 Yangi so‘zni quyidagi formatda yuboring:\n`한국어 - Oʻzbekcha`\n\n" 
-                                        "❌ Bekor qilish uchun tugmani bosing.",
-                                        reply_markup=reply_markup)
-        return ADD_WORD
-    elif text == "🏆 Leaderboard":
-        await show_leaderboard(update, context)
-    elif text == "📊 Progressiyam":
-        await show_progress(update, context)
-    elif text == "🎧 Talaffuz":
-        await update.message.reply_text("Talaffuz qilmoqchi bo‘lgan so‘zni yuboring.")
-        return PRONOUNCE
-    elif text == "📖 Grammar":
-        await show_grammar_levels(update, context)
-    elif text == "🔙 Orqaga":
-        await start(update, context)
-    else:
-        await update.message.reply_text("⚠️ Noto‘g‘ri tanlov. Tugmalardan birini tanlang.")
+
+@menu.route("🎧 Talaffuz")
+async def open_pronounce(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Talaffuz qilmoqchi bo‘lgan so‘zni yuboring.")
+    return PRONOUNCE
 
 
 async def add_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -80,8 +94,9 @@ async def add_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ So'z qo'shish jarayoni bekor qilindi.")
         return ConversationHandler.END
 
-    database.add_user(user_id)
+    store.add_user(user_id)
     message = message.replace("/add", "").strip()
+    dictionary = ko_uz_dictionary.get_dictionary()
 
     lines = message.split("\n")
     added_words = []
@@ -89,29 +104,42 @@ async def add_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
     words_to_add = []
 
     for line in lines:
-        if " - " not in line:
-            failed_lines.append(line)
-            continue
-
-        korean, uzbek = line.split(" - ", 1)
-        korean, uzbek = korean.strip(), uzbek.strip()
+        if " - " in line:
+            korean, uzbek = line.split(" - ", 1)
+            korean, uzbek = korean.strip(), uzbek.strip()
+        else:
+            # Only the Korean word was sent: take the translation from the offline dictionary
+            korean = line.strip()
+            uzbek = dictionary.lookup(korean) if dictionary else None
+            if not korean or not uzbek:
+                failed_lines.append(line)
+                continue
 
         # Ensure it's not a duplicate
-        if database.word_exists(user_id, korean):
+        if store.word_exists(user_id, korean):
             continue
 
         words_to_add.append((korean, uzbek))
         added_words.append(f"🇰🇷 {korean} → 🇺🇿 {uzbek}")
 
     if words_to_add:
-        database.add_flashcard(user_id, words_to_add)
+        # Look for spacing variants and typos of words already in the deck before they are added
+        near_duplicates = similarity.find_near_duplicates(user_id, [korean for korean, _ in words_to_add],
+                                                          store.get_user_words)
+
+        store.add_flashcard(user_id, words_to_add)
+        similarity.add_words(user_id, [korean for korean, _ in words_to_add])
 
         print(f"Adding {len(words_to_add)} words for user {user_id}")
-        database.update_progress(user_id, words_added=len(words_to_add))
+        store.update_progress(user_id, words_added=len(words_to_add))
 
         success_message = "✅ Quyidagi so‘zlar qo‘shildi:\n" + "\n".join(added_words)
         await update.message.reply_text(success_message)
-        return ADD_WORD
+
+        if near_duplicates:
+            warning_message = "⚠️ Bu so‘zlar lug‘atingizdagi so‘zlarga juda o‘xshash:\n" + "\n".join(
+                f"🇰🇷 {word} ≈ {', '.join(similar)}" for word, similar in near_duplicates.items())
+            await update.message.reply_text(warning_message)
     else:
         await update.message.reply_text("⚠️ Hech qanday to‘g‘ri formatdagi so‘z topilmadi.")
 
@@ -120,9 +148,10 @@ async def add_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
         error_message = "⚠️ Quyidagi so‘zlar noto‘g‘ri formatda edi va qo‘shilmadi:\n" + "\n".join(failed_lines)
         await update.message.reply_text(error_message)
 
-    return ConversationHandler.END
+    return ADD_WORD if words_to_add else ConversationHandler.END
 
 
+@callbacks.route("add_word:cancel")
 async def cancel_add_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel the add word process."""
     query = update.callback_query
@@ -137,13 +166,15 @@ async def review_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start a 10-question multiple-choice quiz"""
     user_id = update.message.from_user.id
     try:
-        database.add_user(user_id)
+        store.add_user(user_id)
 
-        flashcards = database.get_due_flashcard(user_id, limit=10)  # Fetch 10 questions
+        flashcards = store.get_due_flashcard(user_id, limit=10)  # Fetch 10 questions
 
         if flashcards:
+            context.user_data["quiz_mode"] = "review"
             context.user_data["quiz_questions"] = flashcards  # Store questions
             context.user_data["quiz_index"] = 0  # Track progress
+            context.user_data["quiz_session"] = uuid.uuid4().hex[:8]
             context.user_data["correct_count"] = 0  # Track correct answers
 
             await ask_next_question(update, context)  # Start quiz
@@ -166,12 +197,15 @@ async def ask_next_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["current_flashcard"] = (flashcard_id, correct_answer)
 
         # Get 3 random incorrect options
-        incorrect_options = database.get_random_wrong_answers(correct_answer, limit=3)
+        incorrect_options = store.get_random_wrong_answers(correct_answer, limit=3, card_id=flashcard_id)
         options = [correct_answer] + incorrect_options
         random.shuffle(options)  # Shuffle options
 
-        # Create inline keyboard
-        buttons = [[InlineKeyboardButton(option, callback_data=option)] for option in options]
+        # Buttons carry quiz:<session>:<question>:<option> so repeated or stale taps can be recognised
+        context.user_data["quiz_options"] = options
+        session = context.user_data["quiz_session"]
+        buttons = [[InlineKeyboardButton(option, callback_data=f"quiz:{session}:{quiz_index}:{number}")]
+                   for number, option in enumerate(options)]
         reply_markup = InlineKeyboardMarkup(buttons)
 
         await update.effective_message.reply_text(f"🇰🇷 {korean}\n\n🇺🇿 Qaysi tarjima to‘g‘ri?",
@@ -180,41 +214,53 @@ async def ask_next_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_quiz_summary(update, context)
 
 
+@callbacks.route("quiz")
 async def check_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle answer selection"""
     query = update.callback_query
     if not query:
         return
-    user_answer = query.data
+
+    # Ignore buttons of an earlier question or quiz
+    answer = dedup.parse_quiz_answer(query.data)
+    if (answer is None or answer[0] != context.user_data.get("quiz_session")
+            or answer[1] != context.user_data.get("quiz_index")):
+        await query.answer()
+        return REVIEW_TEXT
+
+    user_answer = context.user_data["quiz_options"][answer[2]]
     user_id = query.from_user.id
     username = query.from_user.username or f"User_{user_id}"
-    await query.answer()
 
     current_flashcard = context.user_data.get("current_flashcard")
 
     flashcard_id, correct_answer = current_flashcard
+    is_correct = user_answer == correct_answer
 
-    if user_answer == correct_answer:
+    if is_correct:
         context.user_data["correct_count"] += 1
-        database.update_user_score(user_id, username, 5)
-        await query.edit_message_text("✅ To‘g‘ri!")
-        database.update_flashcard_review(flashcard_id, correct=True)
+        store.update_user_score(user_id, username, 5)
+        feedback = "✅ To‘g‘ri!"
     else:
-        await query.edit_message_text(f"❌ Noto‘g‘ri! To‘g‘ri javob: {correct_answer}")
-        database.update_flashcard_review(flashcard_id, correct=False)
+        feedback = f"❌ Noto‘g‘ri! To‘g‘ri javob: {correct_answer}"
 
-    database.track_review(user_id, user_answer == correct_answer)
+    interval = store.update_flashcard_review(flashcard_id, correct=is_correct, user_id=user_id)
+    store.track_review(user_id, is_correct)
+    store.log_review_event(user_id, flashcard_id, is_correct, interval)
     context.user_data["quiz_index"] += 1
 
     # Check if there are more questions
     quiz_index = context.user_data["quiz_index"]
     quiz_questions = context.user_data["quiz_questions"]
 
+    # Answering the tap, editing the old question and sending the next message don't depend on each other
     if quiz_index < len(quiz_questions):
-        await ask_next_question(update, context)
+        await transport.gather_api_calls(query.answer(), query.edit_message_text(feedback),
+                                         ask_next_question(update, context))
         return REVIEW_TEXT
     else:
-        await show_quiz_summary(update, context)
+        await transport.gather_api_calls(query.answer(), query.edit_message_text(feedback),
+                                         show_quiz_summary(update, context))
         return ConversationHandler.END
 
 
@@ -231,12 +277,21 @@ async def show_quiz_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🔥 Davom eting va TOPIKda muvaffaqiyat qozoning!"
     )
 
+    if context.user_data.get("quiz_mode") == "challenge":
+        context.user_data["quiz_mode"] = "review"
+        user = update.effective_user
+        if store.complete_daily_challenge(user.id, context.user_data["challenge_day"], correct_count):
+            bonus = correct_count * CHALLENGE_POINTS
+            store.update_user_score(user.id, user.username or f"User_{user.id}", bonus)
+            summary_text += f"\n🎯 Kunlik chaqiruv bonusi: +{bonus} ball"
+
     await update.effective_message.reply_text(summary_text, parse_mode="Markdown")
 
 
+@menu.route("🏆 Leaderboard")
 async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ Show top 10 users based on their score """
-    top_users = database.get_top_users(limit=10)
+    top_users = store.get_top_users(limit=10)
 
     if not top_users:
         await update.message.reply_text("📉 Hali hech qanday reyting yo'q.")
@@ -258,7 +313,7 @@ async def set_difficulty(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if flashcard_id and difficulty_text in difficulty_mapping:
         difficulty = difficulty_mapping[difficulty_text]
-        database.update_difficulty(flashcard_id, difficulty)
+        store.update_difficulty(flashcard_id, difficulty)
         await update.message.reply_text(
             f"✅ Qiyinlik darajasi {difficulty_text} ga oʻrnatildi. Keyingi takrorlash rejalashtirildi!")
     else:
@@ -268,39 +323,84 @@ async def set_difficulty(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Send reminder to keep users entertaining
 async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """ Sends reminders to users with due flashcards """
-    users = database.get_users_with_due_flashcards()
-
-    for user in users:
-        user_id = user["user_id"]
-        words = database.get_due_flashcard(user_id, limit=10)
-        if words:
+    """ Sends each user the daily challenge prepared overnight, or only the due count when they have none """
+    challenges = store.get_daily_challenges(local_today())
+    # Challenges are drawn from owned cards, so deck-only subscribers are reached through their due cards
+    users = list(challenges) + [user_id for user_id in store.get_users_with_due_flashcards()
+                                if user_id not in challenges]
+
+    for user_id in users:
+        if user_id in challenges:
+            words_text = "\n".join([f"🇰🇷 {korean}" for korean in challenges[user_id]])
+            due_today = store.get_deck_stats(user_id)[4]
+            if due_today:
+                words_text += f"\n📚 Bugun takrorlash kerak: {due_today} ta so‘z"
+            text = f"🎯 **Bugungi chaqiruv:**\n{words_text}\n\n/challenge buyrug‘i bilan javob bering!"
+        else:
+            words = store.get_due_flashcard(user_id, limit=10)
+            if not words:
+                continue
             words_text = "\n".join([f"🇰🇷 {korean}" for _, korean, _ in words])
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"🎯 **Bugungi chaqiruv:**\n{words_text}\n\nJavoblaringizni yuboring!",
-                parse_mode="Markdown"
-            )
+            text = f"📚 **Takrorlash vaqti:**\n{words_text}\n\n📚 Takrorlash tugmasini bosing!"
+        try:
+            await context.bot.send_message(chat_id=user_id, text=text, parse_mode="Markdown")
+        except Exception as e:
+            logger.error(f"Failed to send reminder to {user_id}: {e}")
+
+
+async def start_challenge(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /challenge: play today's precomputed challenge as a quiz """
+    user_id = update.effective_user.id
+    day = local_today()
+    challenge = store.get_daily_challenge(user_id, day)
+
+    if challenge is None:
+        await update.message.reply_text("🎯 Bugun siz uchun chaqiruv yo‘q. Avval so‘z qo‘shing, ertaga tayyor bo‘ladi!")
+        return ConversationHandler.END
+
+    cards, score = challenge
+    if score is not None:
+        await update.message.reply_text(f"✅ Bugungi chaqiruv bajarilgan: {score}/{len(cards)}. Ertaga qaytib keling!")
+        return ConversationHandler.END
 
+    context.user_data["quiz_mode"] = "challenge"
+    context.user_data["challenge_day"] = day
+    context.user_data["quiz_questions"] = cards
+    context.user_data["quiz_index"] = 0
+    context.user_data["quiz_session"] = uuid.uuid4().hex[:8]
+    context.user_data["correct_count"] = 0
 
-def start_scheduler(application: Application):
-    """ Starts the scheduler for reminders """
-    scheduler = BackgroundScheduler(timezone="Asia/Tashkent")  # Set timezone
-    scheduler.add_job(lambda: application.create_task(send_reminder(application)), 'cron', hour=6, minute=0)
-    scheduler.start()
-    return scheduler
+    await ask_next_question(update, context)
+    return REVIEW_TEXT
 
 
-def stop_scheduler(scheduler):
-    """Stop the scheduler gracefully."""
-    logger.info("Stopping scheduler...")
-    scheduler.shutdown(wait=False)
+def in_worker_thread(function, **kwargs):
+    """ Job callback that runs a blocking storage or backup function without holding up the event loop """
+    async def job(context: ContextTypes.DEFAULT_TYPE):
+        await asyncio.to_thread(function, **kwargs)
+
+    job.__name__ = function.__name__
+    return job
+
+
+async def generate_daily_challenges(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(store.generate_daily_challenges, local_today())
+
+
+def schedule_jobs(job_queue):
+    """ Register the periodic jobs on the application's JobQueue; daily times are Tashkent time """
+    job_queue.run_daily(send_reminder, time(6, 0, tzinfo=TIMEZONE))
+    job_queue.run_repeating(in_worker_thread(store.flush_review_events), interval=60, first=60)
+    if isinstance(store, storage.SQLiteStorage):
+        job_queue.run_daily(in_worker_thread(backup.create_snapshot), time(3, 0, tzinfo=TIMEZONE))  # Quietest hour
+    job_queue.run_daily(generate_daily_challenges, time(3, 30, tzinfo=TIMEZONE))  # Ready before the 06:00 burst
+    job_queue.run_daily(in_worker_thread(store.check_deck_stats, repair=True), time(3, 45, tzinfo=TIMEZONE))
 
 
 # Pronunciation Logic
 async def start_pronounce(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ Start pronunciation session """
-    keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data="cancel_pronounce")]]
+    keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data="pronounce:cancel")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await update.message.reply_text("🔊 Iltimos, so‘z kiriting:", reply_markup=reply_markup)
@@ -316,6 +416,8 @@ async def pronounce_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return PRONOUNCE
 
     # Generate speech
+    from gtts import gTTS  # imported on first use to keep startup fast
+
     tts = gTTS(text=text + ".", lang='ko')
     temp_file = tempfile.NamedTemporaryFile(delete=True, suffix=".mp3")
     tts.save(temp_file.name)
@@ -326,7 +428,7 @@ async def pronounce_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     temp_file.close()
 
-    keyboard = [[InlineKeyboardButton("❌ Bekor qilish", callback_data="cancel_pronounce")]]
+    keyboard = [[InlineKeyboardButton("❌ Bekor qilish", callback_data="pronounce:cancel")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await update.message.reply_text("🔊 Yana bir so‘z kiriting yoki '❌ Bekor qilish' tugmasini bosing.",
@@ -334,6 +436,7 @@ async def pronounce_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return PRONOUNCE
 
 
+@callbacks.route("pronounce:cancel")
 async def cancel_pronounce(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ Exit pronunciation session """
     query = update.callback_query
@@ -344,23 +447,43 @@ async def cancel_pronounce(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # User progress
+@menu.route("📊 Progressiyam")
 async def show_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ Display user progress """
     user_id = update.message.chat_id
-    words_added, words_reviewed, correct_answers, accuracy = database.get_user_progress(user_id)
+    words_added, words_reviewed, correct_answers, accuracy = store.get_user_progress(user_id)
+    total, learning, mature, due_now, due_today = store.get_deck_stats(user_id)
 
     progress_text = (
         f"📊 **Your Progress:**\n"
         f"- **Words Added:** {words_added}\n"
         f"- **Words Reviewed:** {words_reviewed}\n"
         f"- **Correct Answers:** {correct_answers}\n"
-        f"- **Accuracy:** {accuracy}%"
+        f"- **Accuracy:** {accuracy}%\n\n"
+        f"🗂 **Kartalar:** {total} (o‘rganilmoqda: {learning}, o‘zlashtirilgan: {mature})\n"
+        f"⏰ **Takrorlash:** hozir {due_now}, bugun {due_today}"
     )
 
+    import analytics  # NumPy is only loaded once someone asks for stats
+
+    stats = await asyncio.to_thread(analytics.user_summary, user_id, store.get_review_events)
+    if stats["reviews"]:
+        def percent(value):
+            return f"{value}%" if value is not None else "—"
+
+        progress_text += (
+            f"\n\n🔥 **Streak:** {stats['current_streak']} kun (eng uzuni: {stats['longest_streak']})\n"
+            f"🧠 **Eslab qolish:** 1 kun {percent(stats['retention_1d'])}, "
+            f"7 kun {percent(stats['retention_7d'])}, 30 kun {percent(stats['retention_30d'])}\n"
+            f"⚠️ **Qiyin so‘zlar:** {stats['weak_cards']}\n"
+            f"📅 **Keyingi 7 kun:** {' / '.join(str(count) for count in stats['forecast'])}"
+        )
+
     await update.message.reply_text(progress_text, parse_mode="Markdown")
 
 
 # Grammar Logic
+@menu.route("📖 Grammar")
 async def show_grammar_levels(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display a message indicating that the Grammar feature is under development."""
     await update.message.reply_text("📖 Grammar bo‘limi hozirda ishlab chiqilmoqda. Tez orada foydalanishingiz mumkin bo‘ladi!")
@@ -368,23 +491,24 @@ async def show_grammar_levels(update: Update, context: ContextTypes.DEFAULT_TYPE
 # async def show_grammar_levels(update: Update, context: ContextTypes.DEFAULT_TYPE):
 #     """Display grammar levels."""
 #     keyboard = [
-#         [InlineKeyboardButton("🟢 Beginner", callback_data="grammar_beginner")],
-#         [InlineKeyboardButton("🟡 Intermediate", callback_data="grammar_intermediate")],
-#         [InlineKeyboardButton("🔴 Advanced", callback_data="grammar_advanced")],
+#         [InlineKeyboardButton("🟢 Beginner", callback_data="grammar:level:beginner")],
+#         [InlineKeyboardButton("🟡 Intermediate", callback_data="grammar:level:intermediate")],
+#         [InlineKeyboardButton("🔴 Advanced", callback_data="grammar:level:advanced")],
 #     ]
 #     reply_markup = InlineKeyboardMarkup(keyboard)
 #     await update.message.reply_text("📖 Choose a grammar level:", reply_markup=reply_markup)
 
 
+@callbacks.route("grammar:level")
 async def show_grammar_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show list of grammar rules for the selected level."""
     query = update.callback_query
     level_map = {
-        "grammar_beginner": "Beginner",
-        "grammar_intermediate": "Intermediate",
-        "grammar_advanced": "Advanced",
+        "beginner": "Beginner",
+        "intermediate": "Intermediate",
+        "advanced": "Advanced",
     }
-    level = level_map.get(query.data)
+    level = level_map.get(query.data.rsplit(":", 1)[1])
 
     if not level:
         return
@@ -403,7 +527,7 @@ async def update_grammar_page(query, context):
     """Update the grammar rule list with pagination."""
     level = context.user_data.get("grammar_level")
     page = context.user_data.get("grammar_page", 0)
-    rules = database.get_grammar_rules_by_level(level)  # Fetch all rules
+    rules = store.get_grammar_rules_by_level(level)  # Fetch all rules
 
     if not rules:
         await query.edit_message_text(f"🚧 No grammar rules found for {level} level.")
@@ -413,16 +537,16 @@ async def update_grammar_page(query, context):
     paginated_rules, total_pages = paginate_items(rules, page, rules_per_page)
 
     keyboard = [
-        [InlineKeyboardButton(title, callback_data=f"grammar_rule_{rule_id}")]
+        [InlineKeyboardButton(title, callback_data=f"grammar:rule:{rule_id}")]
         for rule_id, title in paginated_rules
     ]
 
     # Add "⬅ Orqaga" and "Oldinga ➡" buttons
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Orqaga", callback_data="grammar_prev"))
+        nav_buttons.append(InlineKeyboardButton("⬅️ Orqaga", callback_data="grammar:page:prev"))
     if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton("Oldinga ➡️", callback_data="grammar_next"))
+        nav_buttons.append(InlineKeyboardButton("Oldinga ➡️", callback_data="grammar:page:next"))
 
     if nav_buttons:
         keyboard.append(nav_buttons)
@@ -435,13 +559,14 @@ async def update_grammar_page(query, context):
         logger.error(f"Failed to update grammar page: {e}")
 
 
+@callbacks.route("grammar:rule")
 async def show_grammar_explanation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display a selected grammar rule explanation."""
     query = update.callback_query
-    rule_id = query.data.replace("grammar_rule_", "")
+    rule_id = query.data.rsplit(":", 1)[1]
 
     try:
-        rule = database.get_grammar_rule(rule_id)
+        rule = store.get_grammar_rule(rule_id)
         if not rule:
             await query.edit_message_text("⚠️ This grammar rule is not available.")
             return
@@ -456,6 +581,7 @@ async def show_grammar_explanation(update: Update, context: ContextTypes.DEFAULT
         await query.edit_message_text("⚠️ Xatolik yuz berdi. Keyinroq urinib ko'ring.")
 
 
+@callbacks.route("grammar:page")
 async def handle_grammar_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle '⬅ Orqaga' and 'Oldinga ➡' buttons."""
     query = update.callback_query
@@ -468,14 +594,14 @@ async def handle_grammar_pagination(update: Update, context: ContextTypes.DEFAUL
     # Get current page and total rules
     current_page = context.user_data.get("grammar_page", 0)
     level = context.user_data.get("grammar_level")
-    rules = database.get_grammar_rules_by_level(level)
+    rules = store.get_grammar_rules_by_level(level)
     rules_per_page = 10
     total_pages = (len(rules) - 1) // rules_per_page + 1
 
     # Update page number based on action
-    if action == "grammar_prev":
+    if action == "grammar:page:prev":
         new_page = max(0, current_page - 1)
-    elif action == "grammar_next":
+    elif action == "grammar:page:next":
         new_page = min(total_pages - 1, current_page + 1)
     else:
         new_page = current_page
@@ -489,6 +615,213 @@ async def handle_grammar_pagination(update: Update, context: ContextTypes.DEFAUL
     await update_grammar_page(query, context)
 
 
+# Search Logic
+async def search_words(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ Search the user's own flashcards: /search 사과 """
+    query_text = " ".join(context.args).strip() if context.args else ""
+
+    if not query_text:
+        await update.message.reply_text("🔎 Qidirish uchun so‘z kiriting:\n`/search 한국어` yoki `/search oʻzbekcha`",
+                                        parse_mode="Markdown")
+        return
+
+    context.user_data["search_query"] = query_text
+    context.user_data["search_page"] = 0
+
+    text, reply_markup = render_search_page(update.effective_user.id, context)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+
+@callbacks.route("search:prev", "search:next")
+async def handle_search_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle '⬅ Orqaga' and 'Oldinga ➡' buttons of search results."""
+    query = update.callback_query
+    await query.answer()
+
+    if "search_query" not in context.user_data:
+        await query.edit_message_text("⚠️ Qidiruv muddati tugadi. Qaytadan /search yuboring.")
+        return
+
+    page = context.user_data.get("search_page", 0)
+    context.user_data["search_page"] = max(0, page - 1) if query.data == "search:prev" else page + 1
+
+    text, reply_markup = render_search_page(query.from_user.id, context)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Failed to update search page: {e}")
+
+
+def render_search_page(user_id, context):
+    """Build the text and navigation buttons for the current search page."""
+    query_text = context.user_data["search_query"]
+    page = context.user_data.get("search_page", 0)
+    results_per_page = 10
+
+    cards, total_pages = store.search_flashcards(user_id, query_text, page, results_per_page)
+    if total_pages and page >= total_pages:
+        page = context.user_data["search_page"] = total_pages - 1
+        cards, total_pages = store.search_flashcards(user_id, query_text, page, results_per_page)
+
+    if not cards:
+        return f"🔎 “{query_text}” bo‘yicha hech narsa topilmadi.", None
+
+    lines = [f"🇰🇷 {korean} → 🇺🇿 {uzbek}" for _, korean, uzbek in cards]
+
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Orqaga", callback_data="search:prev"))
+    if page < total_pages - 1:
+        nav_buttons.append(InlineKeyboardButton("Oldinga ➡️", callback_data="search:next"))
+    reply_markup = InlineKeyboardMarkup([nav_buttons]) if nav_buttons else None
+
+    text = f"🔎 “{query_text}” (Sahifa {page + 1}/{total_pages}):\n\n" + "\n".join(lines)
+    return text, reply_markup
+
+
+# Shared decks
+async def show_decks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /decks: list shared word lists with subscribe buttons """
+    text, reply_markup = render_decks(update.effective_user.id)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+
+@callbacks.route("deck:sub", "deck:unsub")
+async def toggle_deck(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ Handle 'deck:sub:<id>' and 'deck:unsub:<id>' buttons """
+    query = update.callback_query
+    await query.answer()
+
+    _, action, deck_id = query.data.split(":")
+    if action == "sub":
+        store.subscribe_deck(query.from_user.id, int(deck_id))
+    else:
+        store.unsubscribe_deck(query.from_user.id, int(deck_id))
+
+    text, reply_markup = render_decks(query.from_user.id)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Failed to update deck list: {e}")
+
+
+def render_decks(user_id):
+    """Build the deck list text and its subscribe/unsubscribe buttons."""
+    decks = store.get_decks(user_id)
+    if not decks:
+        return "📦 Hozircha umumiy so‘z to‘plamlari yo‘q.", None
+
+    keyboard = []
+    for deck_id, name, card_count, subscribed in decks:
+        if subscribed:
+            keyboard.append([InlineKeyboardButton(f"✅ {name} ({card_count})", callback_data=f"deck:unsub:{deck_id}")])
+        else:
+            keyboard.append([InlineKeyboardButton(f"➕ {name} ({card_count})", callback_data=f"deck:sub:{deck_id}")])
+
+    return ("📦 Umumiy so‘z to‘plamlari. Obuna bo‘lsangiz, so‘zlar takrorlashga qo‘shiladi:",
+            InlineKeyboardMarkup(keyboard))
+
+
+# Admin commands
+def is_admin(update: Update):
+    """ Admin commands are only accepted from ADMIN_CHAT_ID """
+    return bool(ADMIN_CHAT_ID) and str(update.effective_chat.id) == ADMIN_CHAT_ID
+
+
+async def create_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /backup: take a database snapshot now and report how long it took """
+    if not is_admin(update):
+        return
+    if not isinstance(store, storage.SQLiteStorage):
+        await update.message.reply_text("⚠️ Zaxira nusxa faqat SQLite ombori uchun mavjud.")
+        return
+
+    await update.message.reply_text("💾 Zaxira nusxa olinmoqda...")
+    try:
+        # Runs in a worker thread, the bot keeps answering users meanwhile
+        path, seconds, size = await asyncio.to_thread(backup.create_snapshot)
+    except Exception as e:
+        logger.error(f"Backup failed: {e}", exc_info=True)
+        await update.message.reply_text(f"⚠️ Zaxira nusxa olinmadi: {e}")
+        return
+
+    await update.message.reply_text(f"✅ Zaxira nusxa tayyor: {os.path.basename(path)}\n"
+                                    f"⏱ {seconds:.2f} s, 📦 {size / 1024 / 1024:.1f} MB")
+
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /stats: counters of the update filters and the busiest routes """
+    if not is_admin(update):
+        return
+
+    routes = sorted(callbacks.report() + menu.report(), key=lambda route: route[1], reverse=True)[:10]
+    routes_text = "".join(f"\n- {route}: {calls} marta, {errors} xato, {ms:.1f} ms"
+                          for route, calls, errors, ms in routes)
+
+    await update.message.reply_text(
+        f"📈 Statistika\n"
+        f"- Takroriy update'lar: {deduplicator.duplicate_updates}\n"
+        f"- Takroriy javob bosishlar: {deduplicator.duplicate_answers}\n"
+        f"- Cheklangan so‘rovlar: {flood_control.throttled}\n\n"
+        f"🧭 Marshrutlar:{routes_text or ' —'}"
+    )
+
+
+async def show_sessions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /sessions: how much per-user state the bot is holding """
+    if not is_admin(update):
+        return
+
+    user_data = context.application.user_data
+    features = session_manager.feature_counts(user_data)
+    await update.message.reply_text(
+        f"🗂 Sessiyalar\n"
+        f"- Faol foydalanuvchilar: {len(session_manager.last_seen)} (user_data: {len(user_data)})\n"
+        f"- Xotira: {session_manager.total / 1024 / 1024:.2f} MB / {session_manager.budget / 1024 / 1024:.0f} MB\n"
+        f"- Holatlar: " + ", ".join(f"{feature} {count}" for feature, count in features.items()) + "\n"
+        f"- Muddati o‘tgan holatlar: {session_manager.expired}, chiqarib yuborilgan sessiyalar: "
+        f"{session_manager.evicted}"
+    )
+
+
+async def run_profiler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /profile [seconds]: sample the running bot and send the collapsed stacks with a top-functions summary """
+    if not is_admin(update):
+        return
+
+    seconds = int(context.args[0]) if context.args and context.args[0].isdigit() else profiler.DEFAULT_SECONDS
+    seconds = max(1, min(seconds, profiler.MAX_SECONDS))
+    await update.message.reply_text(f"🔬 {seconds} soniya davomida profil olinmoqda...")
+
+    try:
+        # The sampler runs in a worker thread so the event loop keeps serving users while it is observed
+        stacks = await asyncio.to_thread(profiler.sample, seconds)
+    except RuntimeError:
+        await update.message.reply_text("⚠️ Profil allaqachon olinmoqda. Tugashini kuting.")
+        return
+
+    await update.message.reply_document(document=profiler.collapse(stacks).encode("utf-8"),
+                                        filename=f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded")
+    await update.message.reply_text(profiler.summarize(stacks, seconds))
+
+
+async def create_deck(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /newdeck <name> followed by `한국어 - Oʻzbekcha` lines: create or extend a shared deck """
+    if not is_admin(update):
+        return
+
+    header, _, body = update.message.text.partition("\n")
+    name = header.replace("/newdeck", "", 1).strip()
+    words = [tuple(part.strip() for part in line.split(" - ", 1)) for line in body.split("\n") if " - " in line]
+
+    if not name or not words:
+        await update.message.reply_text("📝 Format:\n/newdeck TOPIK I\n한국어 - Oʻzbekcha\n...")
+        return
+
+    store.create_deck(name, words)
+    await update.message.reply_text(f"✅ “{name}” to‘plamiga {len(words)} ta so‘z qo‘shildi.")
+
+
 def paginate_items(items, page, items_per_page):
     """Paginate a list of items."""
     start_idx = page * items_per_page
@@ -500,7 +833,7 @@ def paginate_items(items, page, items_per_page):
 async def start_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ Start feedback session """
     logger.info(f"User {update.effective_user.id} triggered /feedback")
-    keyboard = [[InlineKeyboardButton("❌ Bekor qilish", callback_data="cancel_feedback")]]
+    keyboard = [[InlineKeyboardButton("❌ Bekor qilish", callback_data="feedback:cancel")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await update.message.reply_text("📝 Iltimos, fikr-mulohazangizni kiriting:\n\n"
@@ -529,6 +862,7 @@ async def handle_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+@callbacks.route("feedback:cancel")
 async def cancel_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ Exit feedback session """
     query = update.callback_query
@@ -538,45 +872,65 @@ async def cancel_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-def main():
-    app = Application.builder().token(BOT_TOKEN).build()
-    scheduler = start_scheduler(app)
+def warm_caches():
+    """ Import the heavy optional modules ahead of the first request that needs them """
+    import analytics  # noqa: F401
+    import gtts  # noqa: F401
+    logger.info("Caches warmed")
+
+
+async def post_init(application: Application):
+    """ Runs right before polling starts: warm caches without delaying the first update """
+    application.create_task(asyncio.to_thread(warm_caches))
+
 
-    # Handle shutdown signals
-    signal.signal(signal.SIGINT, lambda sig, frame: stop_scheduler(scheduler))
-    signal.signal(signal.SIGTERM, lambda sig, frame: stop_scheduler(scheduler))
+async def post_shutdown(application: Application):
+    """ Write the review events still buffered when the bot stops """
+    store.flush_review_events()
+
+
+def build_application():
+    """ Prepare storage and build the bot with all handlers, ready to start polling """
+    store.init()
+
+    builder = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    app = transport.configure(builder).build()
 
     # Handlers
     conv_handler_pronounce = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^🎧 Talaffuz"), handle_buttons)],
+        entry_points=[menu.message_handler("🎧 Talaffuz")],
         states={
             PRONOUNCE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, pronounce_word),
-                CallbackQueryHandler(cancel_pronounce, pattern="cancel_pronounce")
+                callbacks.callback_handler("pronounce:cancel")
             ],
         },
-        fallbacks=[CallbackQueryHandler(cancel_pronounce, pattern="cancel_pronounce")]
+        fallbacks=[callbacks.callback_handler("pronounce:cancel")],
+        conversation_timeout=sessions.CONVERSATION_TIMEOUT
     )
 
     conv_handler_word = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^➕ So'z qo'shish$"), handle_buttons)],
+        entry_points=[menu.message_handler("➕ So'z qo'shish")],
         states={
             ADD_WORD: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, add_word),
+                callbacks.callback_handler("add_word:cancel")
             ],
         },
         fallbacks=[
-            MessageHandler(filters.Regex("^(❌ Cancel|❌ Bekor qilish)$"), start)  # Handle cancel action
-        ]
+            MessageHandler(filters.Text(["❌ Cancel", "❌ Bekor qilish"]), start)  # Handle cancel action
+        ],
+        conversation_timeout=sessions.CONVERSATION_TIMEOUT
     )
 
     conv_handler_review_text = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^📚 Takrorlash$"), handle_buttons)],
+        entry_points=[menu.message_handler("📚 Takrorlash"),
+                      CommandHandler("challenge", start_challenge)],
         states={
-            REVIEW_TEXT: [CallbackQueryHandler(check_answer)],
+            REVIEW_TEXT: [callbacks.callback_handler("quiz")],
         },
-        fallbacks=[CommandHandler("start", start)]
-
+        fallbacks=[CommandHandler("start", start)],
+        conversation_timeout=sessions.CONVERSATION_TIMEOUT
     )
 
     conv_handler_feedback = ConversationHandler(
@@ -584,27 +938,51 @@ def main():
         states={
             FEEDBACK: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_feedback),
-                CallbackQueryHandler(cancel_feedback, pattern="^cancel_feedback$")
+                callbacks.callback_handler("feedback:cancel")
             ],
         },
         fallbacks=[
             CommandHandler("cancel", cancel_feedback)
-        ]
+        ],
+        conversation_timeout=sessions.CONVERSATION_TIMEOUT
 )
 
 
+    # Session bookkeeping sees every update, then flood control, then duplicate updates are dropped,
+    # before every other handler group. Deduplication comes last so a throttled quiz tap is not recorded
+    # as answered and the user's retry still counts
+    app.add_handler(TypeHandler(Update, session_manager), group=-3)
+    app.add_handler(TypeHandler(Update, flood_control), group=-2)
+    flood_control.routes = [(conv_handler_pronounce, "tts"), (conv_handler_word, "import")]
+    app.add_handler(TypeHandler(Update, deduplicator), group=-1)
+
     # Command handlers
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("search", search_words))
+    app.add_handler(CommandHandler("backup", create_backup))
+    app.add_handler(CommandHandler("stats", show_stats))
+    app.add_handler(CommandHandler("sessions", show_sessions))
+    app.add_handler(CommandHandler("profile", run_profiler))
+    app.add_handler(CommandHandler("newdeck", create_deck))
+    app.add_handler(CommandHandler("decks", show_decks))
+    app.add_handler(callbacks.callback_handler("deck:sub", "deck:unsub", "search:prev", "search:next"))
     app.add_handler(conv_handler_pronounce)
     app.add_handler(conv_handler_word)
     app.add_handler(conv_handler_review_text)
     app.add_handler(conv_handler_feedback)
+    app.add_handler(menu.message_handler())  # The remaining menu buttons, and restarting a flow mid-conversation
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
     # app.add_handler(CommandHandler("grammar", show_grammar_levels))
-    # app.add_handler(CallbackQueryHandler(show_grammar_rules, pattern="^grammar_"))
-    # app.add_handler(CallbackQueryHandler(handle_grammar_pagination, pattern="^grammar_(prev|next)$"))
-    # app.add_handler(CallbackQueryHandler(show_grammar_explanation, pattern="^grammar_rule_"))
-    # app.add_handler(CallbackQueryHandler(cancel_add_word, pattern="cancel_add_word"))
+    # app.add_handler(callbacks.callback_handler("grammar:level", "grammar:rule", "grammar:page"))
+
+    # PTB's JobQueue starts and stops with the application, on the event loop
+    schedule_jobs(app.job_queue)
+
+    return app
+
+
+def main():
+    app = build_application()
 
     logger.info("Bot is running...")
     app.run_polling()
@@ -0,0 +1,143 @@
+""" On-demand sampling profiler for the running bot.
+
+A background thread reads the Python stack of every other thread (the event loop and the worker threads)
+with sys._current_frames() every SAMPLE_INTERVAL seconds. Nothing is hooked into the interpreter, so the
+bot runs at full speed whenever no profile is being taken. The result is written in the collapsed-stack
+format read by flamegraph.pl, speedscope and similar tools:
+
+    MainThread;run_polling (_application.py:650);...;EpollSelector.select (selectors.py:451);(idle) 1234
+
+Samples of a thread waiting for work (see IDLE_LEAVES) end in an "(idle)" frame and are left out of the
+top functions, which are reported per thread with MainThread, the event loop, first. The sampler needs the
+GIL to take a sample and often gets it when the event loop releases it in select(), so read the idle share
+as an upper bound.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # seconds between samples
+DEFAULT_SECONDS = 10
+MAX_SECONDS = 120
+TOP_FUNCTIONS = 15  # for MainThread
+THREAD_TOP_FUNCTIONS = 5  # for every other thread
+
+IDLE = "(idle)"
+# Leaf (file, function) pairs in which a thread blocks until there is work: selector waits, locks, queues
+IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),  # an idle ThreadPoolExecutor worker, blocked in its work queue
+}
+
+_running = threading.Lock()
+
+
+def _label(code):
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _is_idle(code):
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAVES
+
+
+def sample(seconds, interval=SAMPLE_INTERVAL):
+    """ Sample every other thread for `seconds`. Returns a Counter of (thread name, outermost frame, ..., leaf) stacks.
+
+    Raises RuntimeError when another profile is still running.
+    """
+    if not _running.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+
+    try:
+        own = threading.get_ident()
+        stacks = Counter()
+        labels = {}  # code object -> frame label, formatted once per function
+        deadline = time.monotonic() + seconds
+
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                stack = [IDLE] if _is_idle(frame.f_code) else []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                stacks[tuple(reversed(stack))] += 1
+
+            time.sleep(interval)
+        return stacks
+    finally:
+        _running.release()
+
+
+def collapse(stacks):
+    """ One 'thread;frame;...;frame count' line per distinct stack """
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
+
+
+def top_functions(stacks, limit=TOP_FUNCTIONS):
+    """ [(function, self %, total %)] of the functions most often on top of a busy stack, % of all samples """
+    samples = sum(stacks.values())
+    if not samples:
+        return []
+
+    own, inclusive = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack[1:]  # without the thread name
+        if not frames or frames[-1] == IDLE:
+            continue
+        own[frames[-1]] += count
+        for frame in set(frames):  # recursion counts once per sample
+            inclusive[frame] += count
+
+    return [(function, count / samples * 100, inclusive[function] / samples * 100)
+            for function, count in own.most_common(limit)]
+
+
+def by_thread(stacks):
+    """ {thread name: stacks of that thread}, MainThread first, then the busiest threads """
+    threads = {}
+    for stack, count in stacks.items():
+        threads.setdefault(stack[0], Counter())[stack] = count
+
+    def busy(name):
+        return sum(count for stack, count in threads[name].items() if stack[-1] != IDLE)
+
+    return {name: threads[name] for name in sorted(threads, key=lambda name: (name != "MainThread", -busy(name)))}
+
+
+def summarize(stacks, seconds):
+    """ Plain text report of the busiest functions of each thread; threads that were idle throughout share a line """
+    samples = sum(stacks.values())
+    threads = by_thread(stacks)
+    lines = [f"🔬 {seconds} s, {samples} samples, {len(threads)} threads"]
+
+    idle_threads = []
+    for name, thread_stacks in threads.items():
+        thread_samples = sum(thread_stacks.values())
+        idle = sum(count for stack, count in thread_stacks.items() if stack[-1] == IDLE)
+        if idle == thread_samples and name != "MainThread":
+            idle_threads.append(name)
+            continue
+
+        limit = TOP_FUNCTIONS if name == "MainThread" else THREAD_TOP_FUNCTIONS
+        lines += ["", f"🧵 {name}: {idle / thread_samples * 100:.1f}% idle", "self% total% function"]
+        lines += [f"{own:5.1f} {total:6.1f} {function[:90]}"
+                  for function, own, total in top_functions(thread_stacks, limit)]
+
+    if idle_threads:
+        lines += ["", f"💤 Idle: {', '.join(idle_threads)}"]
+    return "\n".join(lines)
@@ -0,0 +1,131 @@
+""" Dict-based dispatch of callback_data namespaces and menu labels to their handlers.
+
+Callback data is `<namespace>[:<action>]:<arguments>`, e.g. `quiz:ab12cd34:3:1` or `grammar:rule:15`.
+A route is a namespace with an optional action; no route may be a prefix of another, so at most one
+of the (at most `depth`) prefixes of a callback matches and lookup cost does not grow with the number
+of routes. Menu labels are routed on the whole stripped text.
+"""
+import time
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, ContextTypes, MessageHandler, filters
+
+SEPARATOR = ":"
+
+
+class RouteStats:
+    __slots__ = ("calls", "errors", "seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+
+class _RouteFilter(filters.MessageFilter):
+    """ Accepts text messages whose label resolves to one of `routes` """
+    __slots__ = ("router", "routes")
+
+    def __init__(self, router, routes):
+        self.router = router
+        self.routes = routes
+        super().__init__(name=f"Route({router.name}: {', '.join(sorted(routes))})")
+
+    def filter(self, message):
+        return self.router.resolve(message.text) in self.routes
+
+
+class Router:
+    """ Routes one kind of update input; `separator` is None for menu labels, ':' for callback data """
+
+    def __init__(self, name, separator=None):
+        self.name = name
+        self.separator = separator
+        self.routes = {}  # route -> async callback(update, context)
+        self.stats = {}  # route -> RouteStats
+        self.depth = 1  # most segments in a registered route
+
+    def __contains__(self, route):
+        return route in self.routes
+
+    def add(self, route, callback):
+        """ Register `callback` for `route`. Raises ValueError for duplicate or overlapping routes """
+        if self.separator is None:
+            route = route.strip()
+        if not route:
+            raise ValueError(f"{self.name}: empty route for {callback.__name__}")
+        if route in self.routes:
+            raise ValueError(f"{self.name}: route {route!r} is registered for both "
+                             f"{self.routes[route].__name__} and {callback.__name__}")
+
+        if self.separator:
+            # Lookup tries every prefix, so a route nested under another could never be reached
+            for other in self.routes:
+                if route.startswith(other + self.separator) or other.startswith(route + self.separator):
+                    raise ValueError(f"{self.name}: routes {other!r} and {route!r} overlap")
+            self.depth = max(self.depth, route.count(self.separator) + 1)
+
+        self.routes[route] = callback
+        self.stats[route] = RouteStats()
+
+    def route(self, *routes):
+        """ Decorator form of add() """
+        def register(callback):
+            for route in routes:
+                self.add(route, callback)
+            return callback
+        return register
+
+    def resolve(self, text):
+        """ The registered route `text` belongs to, or None """
+        if not isinstance(text, str):
+            return None
+        if self.separator is None:
+            text = text.strip()
+            return text if text in self.routes else None
+
+        parts = text.split(self.separator, self.depth)
+        for length in range(1, min(len(parts), self.depth) + 1):
+            route = self.separator.join(parts[:length])
+            if route in self.routes:
+                return route
+        return None
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """ Handler callback: run the route's callback and return its result (a conversation state) """
+        text = update.callback_query.data if update.callback_query else update.effective_message.text
+        route = self.resolve(text)
+        if route is None:
+            return None
+
+        stats = self.stats[route]
+        stats.calls += 1
+        started = time.perf_counter()
+        try:
+            return await self.routes[route](update, context)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.seconds += time.perf_counter() - started
+
+    def _selection(self, routes):
+        unknown = [route for route in routes if route not in self.routes]
+        if unknown:
+            raise ValueError(f"{self.name}: no handler registered for {', '.join(unknown)}")
+        return frozenset(routes or self.routes)
+
+    def callback_handler(self, *routes):
+        """ CallbackQueryHandler for the given routes (all routes when none are given) """
+        selected = self._selection(routes)
+        return CallbackQueryHandler(self.dispatch, pattern=lambda data: self.resolve(data) in selected)
+
+    def message_handler(self, *routes):
+        """ MessageHandler for the given menu labels (all labels when none are given) """
+        return MessageHandler(filters.TEXT & ~filters.COMMAND & _RouteFilter(self, self._selection(routes)),
+                              self.dispatch)
+
+    def report(self):
+        """ [(route, calls, errors, average ms)] of the routes that were used, busiest first """
+        used = [(route, stats) for route, stats in self.stats.items() if stats.calls]
+        used.sort(key=lambda item: item[1].calls, reverse=True)
+        return [(route, stats.calls, stats.errors, stats.seconds / stats.calls * 1000) for route, stats in used]
@@ -0,0 +1,109 @@
+""" Bounds the per-user state kept in context.user_data: idle TTLs per feature and a global memory budget """
+import os
+import sys
+import time
+from collections import OrderedDict
+from telegram import Update
+from telegram.ext import ContextTypes
+
+# Feature -> (user_data keys it owns, seconds of inactivity after which they are dropped)
+FEATURES = {
+    "quiz": (("quiz_mode", "quiz_questions", "quiz_index", "quiz_session", "quiz_options", "current_flashcard",
+              "correct_count", "challenge_day"), 30 * 60),
+    "search": (("search_query", "search_page"), 15 * 60),
+    "grammar": (("grammar_level", "grammar_page"), 30 * 60),
+}
+IDLE_TTL = 24 * 60 * 60  # seconds of inactivity after which a user's whole entry is dropped
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", str(30 * 60)))  # abandoned conversations end
+MEMORY_BUDGET = int(os.getenv("SESSION_MEMORY_BUDGET", str(64 * 1024 * 1024)))  # bytes for all user_data
+SWEEP_EVERY = 60
+
+
+def size_of(value):
+    """ Approximate bytes held by a user_data value, counting nested containers """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(size_of(key) + size_of(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(size_of(item) for item in value)
+    return size
+
+
+class SessionManager:
+    """ Callback for a TypeHandler that sees every update; sweeps at most once per SWEEP_EVERY seconds """
+
+    def __init__(self, features=None, idle_ttl=IDLE_TTL, budget=MEMORY_BUDGET):
+        self.features = features or FEATURES
+        self.idle_ttl = idle_ttl
+        self.budget = budget
+        self.last_seen = OrderedDict()  # user_id -> last update time, least recently active first
+        self.sizes = {}  # user_id -> bytes at the last sweep
+        self.total = 0
+        self.expired = 0  # feature states dropped after their TTL
+        self.evicted = 0  # whole entries dropped for inactivity or the budget
+        self._dirty = set()  # users active since the last sweep, their size may have changed
+        self._last_sweep = time.monotonic()
+
+    def touch(self, user_id, now):
+        self.last_seen[user_id] = now
+        self.last_seen.move_to_end(user_id)
+        self._dirty.add(user_id)
+
+    def sweep(self, user_data, drop, now=None):
+        """ Expire idle feature state, drop idle users, then evict the least recently active users over budget.
+
+        `user_data` is application.user_data, `drop` is application.drop_user_data.
+        """
+        now = time.monotonic() if now is None else now
+        self._last_sweep = now
+        shortest_ttl = min(ttl for _, ttl in self.features.values())
+
+        for user_id, seen in list(self.last_seen.items()):
+            idle = now - seen
+            if idle < shortest_ttl:
+                break  # everyone after this user was active more recently
+            if idle > self.idle_ttl:
+                self._drop(user_id, drop)
+                continue
+
+            data = user_data.get(user_id) or {}
+            for keys, ttl in self.features.values():
+                if idle > ttl and any(key in data for key in keys):
+                    for key in keys:
+                        data.pop(key, None)
+                    self.expired += 1
+                    self._dirty.add(user_id)
+
+        # Only users that were active or trimmed since the last sweep can have changed size
+        for user_id in self._dirty:
+            if user_id in self.last_seen:
+                size = size_of(user_data.get(user_id, {}))
+                self.total += size - self.sizes.get(user_id, 0)
+                self.sizes[user_id] = size
+        self._dirty.clear()
+
+        while self.total > self.budget and self.last_seen:
+            self._drop(next(iter(self.last_seen)), drop)
+
+    def _drop(self, user_id, drop):
+        del self.last_seen[user_id]
+        self.total -= self.sizes.pop(user_id, 0)
+        self._dirty.discard(user_id)
+        self.evicted += 1
+        drop(user_id)
+
+    def feature_counts(self, user_data):
+        """ Feature -> number of users currently holding its state """
+        return {feature: sum(1 for data in user_data.values() if any(key in data for key in keys))
+                for feature, (keys, _) in self.features.items()}
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return
+
+        now = time.monotonic()
+        self.touch(user.id, now)
+        if now - self._last_sweep > SWEEP_EVERY:
+            application = context.application
+            self.sweep(application.user_data, application.drop_user_data, now)
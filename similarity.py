@@ -0,0 +1,148 @@
+""" Near-duplicate detection for Korean words using jamo edit distance and a per-user jamo bigram index """
+import os
+from collections import OrderedDict
+
+HANGUL_BASE = 0xAC00
+HANGUL_LAST = 0xD7A3
+JUNGSEONG_COUNT = 21
+JONGSEONG_COUNT = 28
+
+# user_id -> JamoIndex, built on first lookup, least recently used first; bounded by the words indexed over all users
+CACHE_WORDS = int(os.getenv("SIMILARITY_CACHE_WORDS", "200000"))
+_indexes = OrderedDict()
+_indexed_words = 0
+
+
+def decompose(text):
+    """ Split Hangul syllables into jamo, drop spacing and lowercase the rest """
+    jamo = []
+    for char in text:
+        code = ord(char)
+        if HANGUL_BASE <= code <= HANGUL_LAST:
+            index = code - HANGUL_BASE
+            jamo.append(chr(0x1100 + index // (JUNGSEONG_COUNT * JONGSEONG_COUNT)))
+            jamo.append(chr(0x1161 + (index // JONGSEONG_COUNT) % JUNGSEONG_COUNT))
+            if index % JONGSEONG_COUNT:
+                jamo.append(chr(0x11A7 + index % JONGSEONG_COUNT))
+        elif not char.isspace():
+            jamo.append(char.lower())
+    return "".join(jamo)
+
+
+def edit_distance(a, b, limit=None):
+    """ Levenshtein distance; stops early once every path exceeds `limit` """
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class JamoIndex:
+    """ Jamo bigram index: candidates share enough bigrams with the query, then get an exact distance check """
+
+    def __init__(self):
+        self.words = {}  # jamo key -> original spellings
+        self.grams = {}  # bigram -> set of jamo keys
+
+    @staticmethod
+    def bigrams(key):
+        padded = "^" + key + "$"
+        return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+    def add(self, word):
+        key = decompose(word)
+        if not key:
+            return
+        if key in self.words:
+            self.words[key].append(word)
+            return
+        self.words[key] = [word]
+        for gram in self.bigrams(key):
+            self.grams.setdefault(gram, set()).add(key)
+
+    def search(self, word, max_distance=1):
+        """ Return [(distance, spelling)] for every stored word within `max_distance` jamo edits """
+        key = decompose(word)
+        if not key:
+            return []
+
+        # One edit changes at most two bigrams of the query
+        query_grams = self.bigrams(key)
+        threshold = max(1, len(query_grams) - 2 * max_distance)
+
+        shared = {}
+        for gram in query_grams:
+            for candidate in self.grams.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        matches = []
+        for candidate, count in shared.items():
+            if count < threshold or abs(len(candidate) - len(key)) > max_distance:
+                continue
+            distance = edit_distance(key, candidate, limit=max_distance)
+            if distance <= max_distance:
+                matches.extend((distance, spelling) for spelling in self.words[candidate])
+        return sorted(matches)
+
+
+def get_index(user_id, load_words):
+    """ Return the user's index, building it from `load_words(user_id)` on first use """
+    global _indexed_words
+    index = _indexes.get(user_id)
+    if index is not None:
+        _indexes.move_to_end(user_id)
+        return index
+
+    index = JamoIndex()
+    for word in load_words(user_id):
+        index.add(word)
+    _indexes[user_id] = index
+    _indexed_words += len(index.words)
+    while _indexed_words > CACHE_WORDS and len(_indexes) > 1:
+        forget_user(next(iter(_indexes)))
+    return index
+
+
+def add_words(user_id, words):
+    """ Keep an already built index in sync with newly added words """
+    global _indexed_words
+    index = _indexes.get(user_id)
+    if index is not None:
+        _indexed_words -= len(index.words)
+        for word in words:
+            index.add(word)
+        _indexed_words += len(index.words)
+
+
+def forget_user(user_id):
+    """ Drop a user's index; it will be rebuilt on the next lookup """
+    global _indexed_words
+    index = _indexes.pop(user_id, None)
+    if index is not None:
+        _indexed_words -= len(index.words)
+
+
+def find_near_duplicates(user_id, words, load_words, max_distance=1):
+    """ Check a pasted batch against the user's deck and itself. Returns {word: [similar words]} """
+    index = get_index(user_id, load_words)
+    batch = JamoIndex()
+    duplicates = {}
+    for word in words:
+        matches = index.search(word, max_distance) + batch.search(word, max_distance)
+        similar = list(dict.fromkeys(spelling for _, spelling in sorted(matches) if spelling != word))
+        if similar:
+            duplicates[word] = similar
+        batch.add(word)
+    return duplicates
@@ -0,0 +1,520 @@
+""" Storage backends. Handlers talk to a Storage picked with STORAGE_BACKEND: "sqlite" (default) or "memory" """
+import bisect
+import heapq
+import os
+import random
+import time
+from abc import ABC, abstractmethod
+from datetime import date, timedelta
+
+import database
+
+
+class Storage(ABC):
+    """ Operations every backend provides. SQLiteStorage is the reference behaviour.
+
+    All of them are abstract, so a backend that misses one raises TypeError when it is instantiated.
+    """
+
+    @abstractmethod
+    def init(self):
+        """ Prepare the backend before the bot starts """
+
+    # Flashcards
+    @abstractmethod
+    def add_user(self, user_id):
+        ...
+
+    @abstractmethod
+    def add_flashcard(self, user_id, words):
+        ...
+
+    @abstractmethod
+    def word_exists(self, user_id, korean):
+        ...
+
+    @abstractmethod
+    def get_user_words(self, user_id):
+        ...
+
+    @abstractmethod
+    def search_flashcards(self, user_id, text, page=0, per_page=10):
+        ...
+
+    @abstractmethod
+    def get_due_flashcard(self, user_id, limit=10):
+        ...
+
+    @abstractmethod
+    def get_users_with_due_flashcards(self):
+        ...
+
+    @abstractmethod
+    def get_random_words(self, user_id, limit=3):
+        ...
+
+    @abstractmethod
+    def get_random_wrong_answers(self, correct_answer, limit=3, card_id=None):
+        """ Negative `card_id`s are shared deck cards, answered with translations from the same deck first """
+
+    @abstractmethod
+    def update_flashcard_review(self, flashcard_id, correct, user_id=None):
+        """ Negative ids are shared deck cards, scheduled per `user_id` """
+
+    @abstractmethod
+    def update_difficulty(self, flashcard_id, difficulty):
+        ...
+
+    # Progress and leaderboard
+    @abstractmethod
+    def get_user_progress(self, user_id):
+        ...
+
+    @abstractmethod
+    def update_progress(self, user_id, words_added=0, words_reviewed=0, correct_answers=0):
+        ...
+
+    @abstractmethod
+    def track_review(self, user_id, is_correct):
+        ...
+
+    @abstractmethod
+    def update_user_score(self, user_id, username, points):
+        ...
+
+    @abstractmethod
+    def get_top_users(self, limit=10):
+        ...
+
+    @abstractmethod
+    def get_deck_stats(self, user_id, now=None):
+        """ (total, learning, mature, due now, due today) of the user's cards; unreviewed deck cards are due """
+
+    @abstractmethod
+    def check_deck_stats(self, repair=False):
+        """ Number of users whose stored statistics differ from a recount; rebuilt when `repair` is set """
+
+    # Review history
+    @abstractmethod
+    def log_review_event(self, user_id, flashcard_id, correct, interval):
+        ...
+
+    @abstractmethod
+    def flush_review_events(self):
+        ...
+
+    @abstractmethod
+    def get_review_events(self, user_id, after_id=0):
+        ...
+
+    # Daily challenges
+    @abstractmethod
+    def generate_daily_challenges(self, day=None, size=3, keep_days=7):
+        ...
+
+    @abstractmethod
+    def get_daily_challenge(self, user_id, day=None):
+        ...
+
+    @abstractmethod
+    def get_daily_challenges(self, day=None):
+        ...
+
+    @abstractmethod
+    def complete_daily_challenge(self, user_id, day, score):
+        ...
+
+    # Shared decks
+    @abstractmethod
+    def create_deck(self, name, words):
+        ...
+
+    @abstractmethod
+    def get_decks(self, user_id):
+        ...
+
+    @abstractmethod
+    def subscribe_deck(self, user_id, deck_id):
+        ...
+
+    @abstractmethod
+    def unsubscribe_deck(self, user_id, deck_id):
+        ...
+
+    # Grammar
+    @abstractmethod
+    def get_grammar_rules_by_level(self, level):
+        ...
+
+    @abstractmethod
+    def get_grammar_rule(self, rule_id):
+        ...
+
+
+class SQLiteStorage(Storage):
+    """ The database module, file at database.DB_NAME """
+
+    def init(self):
+        database.init_db()
+
+    add_user = staticmethod(database.add_user)
+    add_flashcard = staticmethod(database.add_flashcard)
+    word_exists = staticmethod(database.word_exists)
+    get_user_words = staticmethod(database.get_user_words)
+    search_flashcards = staticmethod(database.search_flashcards)
+    get_due_flashcard = staticmethod(database.get_due_flashcard)
+    get_users_with_due_flashcards = staticmethod(database.get_users_with_due_flashcards)
+    get_random_words = staticmethod(database.get_random_words)
+    get_random_wrong_answers = staticmethod(database.get_random_wrong_answers)
+    update_flashcard_review = staticmethod(database.update_flashcard_review)
+    update_difficulty = staticmethod(database.update_difficulty)
+
+    get_user_progress = staticmethod(database.get_user_progress)
+    update_progress = staticmethod(database.update_progress)
+    track_review = staticmethod(database.track_review)
+    update_user_score = staticmethod(database.update_user_score)
+    get_top_users = staticmethod(database.get_top_users)
+    get_deck_stats = staticmethod(database.get_deck_stats)
+    check_deck_stats = staticmethod(database.check_deck_stats)
+
+    log_review_event = staticmethod(database.log_review_event)
+    flush_review_events = staticmethod(database.flush_review_events)
+    get_review_events = staticmethod(database.get_review_events)
+
+    generate_daily_challenges = staticmethod(database.generate_daily_challenges)
+    get_daily_challenge = staticmethod(database.get_daily_challenge)
+    get_daily_challenges = staticmethod(database.get_daily_challenges)
+    complete_daily_challenge = staticmethod(database.complete_daily_challenge)
+
+    create_deck = staticmethod(database.create_deck)
+    get_decks = staticmethod(database.get_decks)
+    subscribe_deck = staticmethod(database.subscribe_deck)
+    unsubscribe_deck = staticmethod(database.unsubscribe_deck)
+
+    get_grammar_rules_by_level = staticmethod(database.get_grammar_rules_by_level)
+    get_grammar_rule = staticmethod(database.get_grammar_rule)
+
+
+class Card:
+    __slots__ = ("id", "user_id", "korean", "uzbek", "last_reviewed", "difficulty", "next_review", "interval",
+                 "correct_streak")
+
+    def __init__(self, card_id, user_id, korean, uzbek, now):
+        self.id = card_id
+        self.user_id = user_id
+        self.korean = korean
+        self.uzbek = uzbek
+        self.last_reviewed = now
+        self.difficulty = 0
+        self.next_review = now
+        self.interval = 1
+        self.correct_streak = 0
+
+
+class MemoryStorage(Storage):
+    """ Everything in process memory: dict indexes and lazily cleaned heaps. Data is lost on restart """
+
+    def __init__(self):
+        self.cards = {}  # id -> Card
+        self.user_cards = {}  # user_id -> {korean: [Card]}
+        self.review_queues = {}  # user_id -> heap of (last_reviewed, id), stale entries skipped
+        self.translations = []  # distinct uzbek words, for wrong answer options
+        self.translation_set = set()
+        self.progress = {}  # user_id -> [words_added, words_reviewed, correct_answers]
+        self.leaderboard = {}  # user_id -> [username, score]
+        self.events = {}  # user_id -> [(id, flashcard_id, reviewed_at, correct, interval)]
+        self.decks = {}  # deck id -> (name, [deck card ids])
+        self.deck_names = {}  # name -> deck id
+        self.deck_cards = {}  # deck card id -> (korean, uzbek)
+        self.card_decks = {}  # deck card id -> deck id
+        self.subscriptions = {}  # user_id -> {deck id: subscribed_at}
+        self.deck_reviews = {}  # (user_id, deck card id) -> [interval, correct_streak, last_reviewed, next_review]
+        self.challenges = {}  # day -> {user_id: [card ids, score]}
+        self.grammar = {}  # id -> (level, title, explanation, examples)
+        self.grammar_by_level = {}  # level -> [(id, title)]
+        self._next_card_id = 1
+        self._next_deck_card_id = 1
+        self._next_event_id = 1
+
+    def init(self):
+        for rule_id, (level, title, explanation, examples) in enumerate(database.grammar_rules, start=1):
+            self.grammar[rule_id] = (level, title, explanation, examples)
+            self.grammar_by_level.setdefault(level, []).append((rule_id, title))
+
+    # Flashcards
+    def add_user(self, user_id):
+        self.progress.setdefault(user_id, [0, 0, 0])
+
+    def add_flashcard(self, user_id, words):
+        now = database.local_now()
+        by_word = self.user_cards.setdefault(user_id, {})
+        queue = self.review_queues.setdefault(user_id, [])
+
+        for korean, uzbek in words:
+            card = Card(self._next_card_id, user_id, korean, uzbek, now)
+            self._next_card_id += 1
+            self.cards[card.id] = card
+            by_word.setdefault(korean, []).append(card)
+            heapq.heappush(queue, (card.last_reviewed, card.id))
+            if uzbek not in self.translation_set:
+                self.translation_set.add(uzbek)
+                self.translations.append(uzbek)
+
+        self.add_user(user_id)
+        self.progress[user_id][0] += len(words)
+
+    def word_exists(self, user_id, korean):
+        return korean in self.user_cards.get(user_id, {})
+
+    def _user_cards(self, user_id):
+        return [card for cards in self.user_cards.get(user_id, {}).values() for card in cards]
+
+    def get_user_words(self, user_id):
+        return [card.korean for card in self._user_cards(user_id)]
+
+    def search_flashcards(self, user_id, text, page=0, per_page=10):
+        needles = text.casefold().split()
+        if not needles:
+            return [], 0
+
+        matches = [(card.id, card.korean, card.uzbek) for card in self._user_cards(user_id)
+                   if all(needle in card.korean.casefold() or needle in card.uzbek.casefold() for needle in needles)]
+        total_pages = (len(matches) - 1) // per_page + 1 if matches else 0
+        return matches[page * per_page:(page + 1) * per_page], total_pages
+
+    def get_due_flashcard(self, user_id, limit=10):
+        queue = self.review_queues.get(user_id, [])
+        picked = {}
+        while queue and len(picked) < limit:
+            last_reviewed, card_id = heapq.heappop(queue)
+            if self.cards[card_id].last_reviewed == last_reviewed:
+                picked[card_id] = self.cards[card_id]
+
+        for card in picked.values():
+            heapq.heappush(queue, (card.last_reviewed, card.id))
+        # (when, tie-break, id handed out, korean, uzbek)
+        candidates = [(card.last_reviewed, card.id, card.id, card.korean, card.uzbek) for card in picked.values()]
+
+        # Deck cards never reviewed count from the subscription date
+        for deck_id, subscribed_at in self.subscriptions.get(user_id, {}).items():
+            for card_id in self.decks[deck_id][1]:
+                review = self.deck_reviews.get((user_id, card_id))
+                korean, uzbek = self.deck_cards[card_id]
+                candidates.append((review[2] if review else subscribed_at, card_id, -card_id, korean, uzbek))
+
+        return [(card_id, korean, uzbek) for _, _, card_id, korean, uzbek in heapq.nsmallest(limit, candidates)]
+
+    def get_users_with_due_flashcards(self):
+        now = database.local_now()
+        users = {card.user_id for card in self.cards.values() if card.next_review <= now}
+        for user_id, decks in self.subscriptions.items():
+            for deck_id in decks:
+                for card_id in self.decks[deck_id][1]:
+                    review = self.deck_reviews.get((user_id, card_id))
+                    if review is None or review[3] <= now:
+                        users.add(user_id)
+                        break
+        return list(users)
+
+    def get_random_words(self, user_id, limit=3):
+        cards = self._user_cards(user_id)
+        return [(card.id, card.korean, card.uzbek) for card in random.sample(cards, min(limit, len(cards)))]
+
+    def get_random_wrong_answers(self, correct_answer, limit=3, card_id=None):
+        wrong_answers = []
+        if card_id is not None and database.is_shared_card(card_id):
+            deck = self.decks[self.card_decks[-card_id]][1]
+            answers = sorted({self.deck_cards[other][1] for other in deck} - {correct_answer})
+            wrong_answers = random.sample(answers, min(limit, len(answers)))
+
+        if len(wrong_answers) < limit:
+            pool = random.sample(self.translations, min(limit + 1, len(self.translations)))
+            wrong_answers += [answer for answer in pool
+                              if answer != correct_answer and answer not in wrong_answers][:limit - len(wrong_answers)]
+
+        while len(wrong_answers) < limit:
+            wrong_answers.append(random.choice(wrong_answers) if wrong_answers else "Nomaʼlum")
+        return wrong_answers
+
+    def _touch(self, card):
+        card.last_reviewed = database.local_now()
+        heapq.heappush(self.review_queues[card.user_id], (card.last_reviewed, card.id))
+
+    @staticmethod
+    def _next_interval(interval, correct_streak, correct):
+        if correct:
+            return (interval * 2 if correct_streak >= 5 else interval + 1), correct_streak + 1
+        return 1, 0
+
+    def update_flashcard_review(self, flashcard_id, correct, user_id=None):
+        if database.is_shared_card(flashcard_id):
+            review = self.deck_reviews.get((user_id, -flashcard_id), [1, 0, None, None])
+            interval, correct_streak = self._next_interval(review[0], review[1], correct)
+            now = database.local_now()
+            self.deck_reviews[(user_id, -flashcard_id)] = [interval, correct_streak, now,
+                                                           now + timedelta(days=interval)]
+            return interval
+
+        card = self.cards.get(flashcard_id)
+        if card is None:
+            return 1
+
+        card.interval, card.correct_streak = self._next_interval(card.interval, card.correct_streak, correct)
+        self._touch(card)
+        card.next_review = card.last_reviewed + timedelta(days=card.interval)
+        return card.interval
+
+    def update_difficulty(self, flashcard_id, difficulty):
+        card = self.cards.get(flashcard_id)
+        if card is None:
+            return
+
+        review_intervals = {1: 1, 2: 3, 3: 7}
+        card.interval = card.interval * 2 if difficulty == 3 else review_intervals[difficulty]
+        card.difficulty = difficulty
+        card.next_review = database.local_now() + timedelta(days=card.interval)
+        self._touch(card)
+
+    # Progress and leaderboard
+    def get_user_progress(self, user_id):
+        words_added, words_reviewed, correct_answers = self.progress.get(user_id, (0, 0, 0))
+        accuracy = round((correct_answers / words_reviewed) * 100, 2) if words_reviewed > 0 else 0
+        return words_added, words_reviewed, correct_answers, accuracy
+
+    def update_progress(self, user_id, words_added=0, words_reviewed=0, correct_answers=0):
+        progress = self.progress.get(user_id)
+        if progress:
+            progress[0] += words_added
+            progress[1] += words_reviewed
+            progress[2] += correct_answers
+
+    def track_review(self, user_id, is_correct):
+        self.add_user(user_id)
+        self.update_progress(user_id, words_reviewed=1, correct_answers=1 if is_correct else 0)
+
+    def update_user_score(self, user_id, username, points):
+        entry = self.leaderboard.setdefault(user_id, [username, 0])
+        entry[1] += points
+
+    def get_top_users(self, limit=10):
+        return [tuple(entry) for entry in heapq.nlargest(limit, self.leaderboard.values(), key=lambda e: e[1])]
+
+    def get_deck_stats(self, user_id, now=None):
+        # Counted on demand, with the same hour granularity as the SQLite buckets
+        now = now or database.local_now()
+        hour_end = now.replace(minute=59, second=59, microsecond=999999)
+        day_end = hour_end.replace(hour=23)
+
+        schedules = [(card.interval, card.next_review) for card in self._user_cards(user_id)]
+        for deck_id, subscribed_at in self.subscriptions.get(user_id, {}).items():
+            for card_id in self.decks[deck_id][1]:
+                review = self.deck_reviews.get((user_id, card_id))
+                # A card never reviewed is due from the subscription date
+                schedules.append((review[0], review[3]) if review else (1, subscribed_at))
+
+        mature = sum(interval >= database.MATURE_INTERVAL for interval, _ in schedules)
+        due_now = sum(next_review <= hour_end for _, next_review in schedules)
+        due_today = sum(next_review <= day_end for _, next_review in schedules)
+        return len(schedules), len(schedules) - mature, mature, due_now, due_today
+
+    def check_deck_stats(self, repair=False):
+        return 0  # nothing is materialized, so nothing can drift
+
+    # Review history
+    def log_review_event(self, user_id, flashcard_id, correct, interval):
+        event = (self._next_event_id, flashcard_id, time.time(), 1 if correct else 0, interval)
+        self._next_event_id += 1
+        self.events.setdefault(user_id, []).append(event)
+
+    def flush_review_events(self):
+        pass
+
+    def get_review_events(self, user_id, after_id=0):
+        events = self.events.get(user_id, [])
+        return events[bisect.bisect_right(events, (after_id, float("inf"))):]
+
+    # Daily challenges
+    def generate_daily_challenges(self, day=None, size=3, keep_days=7):
+        day = day or database.local_today()
+        challenges = {}
+        for user_id in self.user_cards:
+            cards = self._user_cards(user_id)
+            if cards:
+                challenges[user_id] = [[card.id for card in random.sample(cards, min(size, len(cards)))], None]
+        self.challenges[day] = challenges
+        oldest = (date.fromisoformat(day) - timedelta(days=keep_days)).isoformat()
+        for old_day in [old_day for old_day in self.challenges if old_day < oldest]:
+            del self.challenges[old_day]
+        return len(self.challenges[day])
+
+    def get_daily_challenge(self, user_id, day=None):
+        challenge = self.challenges.get(day or database.local_today(), {}).get(user_id)
+        if challenge is None:
+            return None
+        card_ids, score = challenge
+        return [(card_id, self.cards[card_id].korean, self.cards[card_id].uzbek) for card_id in card_ids], score
+
+    def get_daily_challenges(self, day=None):
+        return {user_id: [self.cards[card_id].korean for card_id in card_ids]
+                for user_id, (card_ids, score) in self.challenges.get(day or database.local_today(), {}).items()
+                if score is None}
+
+    def complete_daily_challenge(self, user_id, day, score):
+        challenge = self.challenges.get(day, {}).get(user_id)
+        if challenge is None or challenge[1] is not None:
+            return False
+        challenge[1] = score
+        return True
+
+    # Shared decks
+    def create_deck(self, name, words):
+        deck_id = self.deck_names.get(name)
+        if deck_id is None:
+            deck_id = self.deck_names[name] = len(self.decks) + 1
+            self.decks[deck_id] = (name, [])
+
+        for korean, uzbek in words:
+            self.deck_cards[self._next_deck_card_id] = (korean, uzbek)
+            self.card_decks[self._next_deck_card_id] = deck_id
+            self.decks[deck_id][1].append(self._next_deck_card_id)
+            self._next_deck_card_id += 1
+        return deck_id
+
+    def get_decks(self, user_id):
+        subscribed = self.subscriptions.get(user_id, {})
+        return sorted(((deck_id, name, len(card_ids), deck_id in subscribed)
+                       for deck_id, (name, card_ids) in self.decks.items()), key=lambda deck: deck[1])
+
+    def subscribe_deck(self, user_id, deck_id):
+        if deck_id in self.decks:
+            self.subscriptions.setdefault(user_id, {}).setdefault(deck_id, database.local_now())
+
+    def unsubscribe_deck(self, user_id, deck_id):
+        if self.subscriptions.get(user_id, {}).pop(deck_id, None) is not None:
+            for card_id in self.decks[deck_id][1]:
+                self.deck_reviews.pop((user_id, card_id), None)
+
+    # Grammar
+    def get_grammar_rules_by_level(self, level):
+        return list(self.grammar_by_level.get(level, []))
+
+    def get_grammar_rule(self, rule_id):
+        rule = self.grammar.get(int(rule_id))
+        if rule:
+            _, title, explanation, examples = rule
+            return title, explanation, examples.split(" / ")
+        return None
+
+
+BACKENDS = {
+    "sqlite": SQLiteStorage,
+    "memory": MemoryStorage,
+}
+
+
+def get_storage(backend=None):
+    """ Create the backend named by `backend` or the STORAGE_BACKEND environment variable """
+    name = (backend or os.getenv("STORAGE_BACKEND", "sqlite")).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown STORAGE_BACKEND '{name}', expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
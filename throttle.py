@@ -0,0 +1,112 @@
+""" Per-user flood control: a token bucket per user and action class, checked before any handler runs """
+import time
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+# Action class -> (bucket size, tokens refilled per second)
+LIMITS = {
+    "read": (20, 1.0),     # menu buttons, quiz answers, search, progress
+    "tts": (5, 0.2),       # pronunciation requests, one gTTS synthesis each
+    "import": (3, 0.1),    # messages to add_word, single words or pasted lists
+}
+IDLE_TTL = 10 * 60  # seconds without updates before a bucket is dropped
+SWEEP_EVERY = 60
+
+MENU_LABELS = {"📚 Takrorlash", "📖 Grammar", "🏆 Leaderboard", "📊 Progressiyam", "🎧 Talaffuz",
+               "➕ So'z qo'shish", "🔙 Orqaga", "❌ Cancel", "❌ Bekor qilish"}
+
+
+def classify(update: Update, routes=()):
+    """ Pick the action class an update is charged to: that of the first route whose handler takes it, else "read" """
+    message = update.message
+    if update.callback_query or not message or not message.text:
+        return "read"
+
+    text = message.text.strip()
+    if text.startswith("/") or text in MENU_LABELS:
+        return "read"
+    for handler, action in routes:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return action
+    return "read"
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "notified")
+
+    def __init__(self, capacity, now):
+        self.tokens = capacity
+        self.updated = now
+        self.notified = False
+
+    def take(self, capacity, rate, now):
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class FloodControl:
+    """ Callback for a TypeHandler in a group before all others; drops updates of users over their limit """
+
+    def __init__(self, limits=None, idle_ttl=IDLE_TTL):
+        self.limits = limits or LIMITS
+        self.idle_ttl = idle_ttl
+        self.buckets = {}  # (user_id, action) -> TokenBucket
+        # (handler, action): text a handler would take is charged to its action. A ConversationHandler
+        # answers for the user's current state, so a word sent to add_word is an import, not a TTS request
+        self.routes = []
+        self.throttled = 0
+        self._last_sweep = time.monotonic()
+
+    def allow(self, user_id, action, now=None):
+        """ Returns (allowed, notify): notify is True only for the first rejected update of a burst """
+        now = time.monotonic() if now is None else now
+        if now - self._last_sweep > SWEEP_EVERY:
+            self.sweep(now)
+
+        capacity, rate = self.limits[action]
+        bucket = self.buckets.get((user_id, action))
+        if bucket is None:
+            bucket = self.buckets[(user_id, action)] = TokenBucket(capacity, now)
+
+        if bucket.take(capacity, rate, now):
+            bucket.notified = False
+            return True, False
+
+        self.throttled += 1
+        notify = not bucket.notified
+        bucket.notified = True
+        return False, notify
+
+    def sweep(self, now):
+        """ Forget buckets that have been idle long enough to be full again """
+        self._last_sweep = now
+        idle = [key for key, bucket in self.buckets.items() if now - bucket.updated > self.idle_ttl]
+        for key in idle:
+            del self.buckets[key]
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return
+
+        allowed, notify = self.allow(user.id, classify(update, self.routes))
+        if allowed:
+            return
+
+        text = "⏳ Juda ko‘p so‘rov yubordingiz. Biroz kuting va qayta urinib ko‘ring."
+        try:
+            if update.callback_query:
+                # Every dropped tap is answered, or the button keeps spinning until Telegram gives up on it
+                await update.callback_query.answer(text if notify else None)
+            elif notify and update.effective_message:
+                await update.effective_message.reply_text(text)
+        except TelegramError:
+            pass  # e.g. a query too old to answer; the update is still dropped
+
+        raise ApplicationHandlerStop
@@ -0,0 +1,107 @@
+""" Bot API transport settings and a helper for running independent API calls concurrently """
+import asyncio
+import logging
+import os
+import sys
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.getenv("BOT_POOL_SIZE", "32"))  # connections kept alive to the Bot API
+HTTP_VERSION = os.getenv("BOT_HTTP_VERSION", "2")  # "2" needs python-telegram-bot[http2], falls back to 1.1
+# Updates processed at the same time. 0 keeps PTB's one-by-one processing, which ConversationHandler expects;
+# above 0, updates of different users overlap but each user's updates still run in order (SequencedApplication)
+CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "0"))
+CONNECT_TIMEOUT = float(os.getenv("BOT_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("BOT_READ_TIMEOUT", "10"))
+WRITE_TIMEOUT = float(os.getenv("BOT_WRITE_TIMEOUT", "10"))
+POOL_TIMEOUT = float(os.getenv("BOT_POOL_TIMEOUT", "3"))
+
+# e.g. http://127.0.0.1:8081/bot to run against a local fake Bot API server, see bench_transport.py
+BASE_URL = os.getenv("BOT_API_BASE_URL")
+
+
+class SequencedApplication(Application):
+    """ Application that lets updates of different users overlap but processes one user's updates in order.
+
+    Conversation states and the quiz keys in user_data are per user, so two updates of the same user must not
+    be checked against the same old state. The key is the user (or the chat for updates without a user).
+
+    PTB 20.3 takes its concurrent_updates slot before process_update runs, so updates queued behind their
+    user's lock would hold slots and one busy user could stall everyone. PTB's own limit is therefore left
+    unbounded (see configure) and `max_running` slots are taken only once an update is first in its user's line.
+    """
+    __slots__ = ("_sequences", "_update_slots")
+
+    def __init__(self, max_running=CONCURRENT_UPDATES, **kwargs):
+        super().__init__(**kwargs)
+        self._sequences = {}  # key -> [lock, updates holding or waiting for it]
+        self._update_slots = asyncio.Semaphore(max_running)
+
+    @staticmethod
+    def sequence_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return "user", update.effective_user.id
+        if update.effective_chat:
+            return "chat", update.effective_chat.id
+        return None
+
+    async def process_update(self, update):
+        key = self.sequence_key(update)
+        if key is None:
+            async with self._update_slots:
+                return await super().process_update(update)
+
+        sequence = self._sequences.get(key)
+        if sequence is None:
+            sequence = self._sequences[key] = [asyncio.Lock(), 0]
+        sequence[1] += 1
+        try:
+            async with sequence[0], self._update_slots:
+                await super().process_update(update)
+        finally:
+            sequence[1] -= 1
+            if not sequence[1]:
+                del self._sequences[key]
+
+
+def build_request(pool_size=POOL_SIZE):
+    """ HTTPX transport with a shared keep-alive pool """
+    settings = dict(connection_pool_size=pool_size, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                    write_timeout=WRITE_TIMEOUT, pool_timeout=POOL_TIMEOUT)
+    try:
+        return HTTPXRequest(http_version=HTTP_VERSION, **settings)
+    except RuntimeError:
+        logger.warning("HTTP/2 needs python-telegram-bot[http2], using HTTP/1.1")
+        return HTTPXRequest(http_version="1.1", **settings)
+
+
+def configure(builder):
+    """ Apply the transport settings to an ApplicationBuilder """
+    builder = (builder
+               .request(build_request())
+               .get_updates_request(build_request(pool_size=1)))  # long polling holds one connection
+    if CONCURRENT_UPDATES > 0:
+        builder = (builder
+                   .application_class(SequencedApplication, kwargs={"max_running": CONCURRENT_UPDATES})
+                   .concurrent_updates(sys.maxsize))  # the limit is applied by SequencedApplication
+    if BASE_URL:
+        builder = builder.base_url(BASE_URL)
+    return builder
+
+
+async def gather_api_calls(*calls):
+    """ Await independent Bot API calls at the same time, e.g. editing the old message and sending the next one.
+
+    Only use it for calls whose order in the chat doesn't matter. Every call is awaited to the end,
+    then the first error (if any) is raised.
+    """
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results